@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+
+from direct.showbase.DirectObject import DirectObject
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+import savefile
+
+
+notify = directNotify.newCategory('autosave')
+
+
+class Autosave(DirectObject):
+    """
+    Keeps a .dorfz checkpoint of the world plus a journal of the chunks changed since.
+
+    Every `interval` seconds the chunks dirtied since the last tick are copied on the
+    main thread and appended to the journal by a background thread; once the journal
+    grows past `journal_limit` bytes, a full snapshot replaces the checkpoint instead.
+    """
+
+    def __init__(self, world, fn, interval=5.0, journal_limit=16 * 1024 * 1024):
+        fn = savefile.with_extension(fn, savefile.CHUNKED_EXTENSION)
+        if os.path.splitext(fn)[1] != savefile.CHUNKED_EXTENSION:
+            raise ValueError('Autosave needs a {} file'.format(savefile.CHUNKED_EXTENSION))
+
+        self.world = world
+        self.fn = fn
+        self.journal = fn + savefile.JOURNAL_SUFFIX
+        self.journal_limit = journal_limit
+        # Grown by the writer thread, read and reset by the main thread
+        self.journal_bytes = 0
+        self.lock = threading.Lock()
+
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='autosave')
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.checkpoint()
+        self.doMethodLater(interval, self.tick, 'Autosave')
+
+    def destroy(self):
+        self.ignoreAll()
+        self.removeAllTasks()
+        self.jobs.put(None)
+
+    def checkpoint(self):
+        self.world.blocks.take_dirty()
+        with self.lock:
+            self.journal_bytes = 0
+        self.jobs.put((self.write_checkpoint, self.world.blocks.snapshot()))
+
+    def tick(self, task):
+        dirty = self.world.blocks.take_dirty()
+        if dirty:
+            with self.lock:
+                full = self.journal_bytes > self.journal_limit
+            if full:
+                self.checkpoint()
+            else:
+                self.jobs.put((self.write_journal, self.world.blocks.snapshot(dirty)))
+        return task.again
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            method, snapshot = job
+            try:
+                method(snapshot)
+            except Exception as e:
+                notify.warning('Autosave failed: {}'.format(e))
+
+    def write_checkpoint(self, snapshot):
+        checkpoint = savefile.new_checkpoint()
+        self.world.save_chunked(self.fn + '.tmp', snapshot, checkpoint)
+        self.world.start_journal(self.journal + '.tmp', checkpoint)
+        os.replace(self.fn + '.tmp', self.fn)
+        os.replace(self.journal + '.tmp', self.journal)
+        notify.info('Checkpoint written to {}'.format(self.fn))
+
+    def write_journal(self, snapshot):
+        written = savefile.append_journal(self.journal, snapshot.chunks.values())
+        with self.lock:
+            self.journal_bytes += written
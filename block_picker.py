@@ -1,10 +1,18 @@
 from direct.showbase.DirectObject import DirectObject
 from direct.showbase.PythonUtil import bound
 
-from panda3d.core import Point3, Vec3, Vec4, Plane, Shader
+from panda3d.core import Point2, Point3, Vec3, Vec4, Plane, Shader
+
+from storage import CHUNK_SIZE
 
 
 class BlockPicker(DirectObject):
+    """
+    Picks the cell under the mouse: in SURFACE mode the empty cell on top of the first
+    non-void cell along the mouse ray, in SLICE mode the cell of the current slice.
+    The pick is only computed again when the mouse, the camera or the slice moves,
+    or when blocks change in the chunks along the last ray.
+    """
     SURFACE = 0
     SLICE = 1
 
@@ -24,19 +32,51 @@ class BlockPicker(DirectObject):
         self.constraint = BlockPicker.SURFACE
         self.slice = None
 
+        self.view = None
+        self.ray_tiles = set()
+        self.ray_top = None
+
         self.addTask(self.pick_block, "Pick block")
         self.accept('slice-changed', self.slice_changed)
+        self.accept('blocks-updated', self.blocks_updated)
 
     def pick_point(self, z, near, far):
         plane = self.picking_planes[z]
         pos3d = Point3()
-        if plane.intersectsLine(pos3d,
-                                self.app.render.getRelativePoint(self.app.cam, near),
-                                self.app.render.getRelativePoint(self.app.cam, far)):
+        if plane.intersectsLine(pos3d, near, far):
             return pos3d
         else:
             raise ValueError('Camera is coplanar to the picking plane')
 
+    def pick(self, near, far):
+        """
+        The cell picked by the ray from `near` to `far`, in world coordinates, or None.
+        Needs no window, so tools and tests can pick too.
+        """
+        if self.constraint == BlockPicker.SURFACE:
+            visited = []
+            hit = self.world.raycast(near, far - near, visited=visited)
+            self.ray_tiles = set((z, x // CHUNK_SIZE, y // CHUNK_SIZE) for x, y, z in visited)
+            self.ray_top = max(z for _, _, z in visited) if visited else -1
+            if hit is None:
+                return None
+            (x, y, z), _ = hit
+            return x, y, min(z + 1, self.world.depth - 1)
+
+        self.ray_tiles = set()
+        self.ray_top = None
+        try:
+            point = self.pick_point(self.slice, near, far)
+        except ValueError:
+            return None
+        return self.clamp_point(point, (0.5, 0.5, -0.5))
+
+    def invalidate(self):
+        """
+        Makes the next frame pick again, for changes the picker does not hear about.
+        """
+        self.view = None
+
     def slice_changed(self, slice, explore):
         if explore:
             self.constraint = BlockPicker.SURFACE
@@ -44,6 +84,14 @@ class BlockPicker(DirectObject):
             self.constraint = BlockPicker.SLICE
 
         self.slice = slice
+        self.invalidate()
+
+    def blocks_updated(self, chunks):
+        if self.ray_top is None:
+            return
+        # Blocks above the part of the ray that was marched may raise the surface into its way
+        if any(tile in self.ray_tiles or tile[0] > self.ray_top for tile in chunks):
+            self.invalidate()
 
     def clamp_point(self, point, shift):
         px, py, pz = point
@@ -64,27 +112,19 @@ class BlockPicker(DirectObject):
             return task.again
 
         if self.mouse.hasMouse():
-            mouse_pos = self.mouse.getMouse()
+            mouse_pos = Point2(self.mouse.getMouse())
+            camera = self.app.cam.getMat(self.app.render)
+            view = (tuple(mouse_pos),) + tuple(tuple(camera.getRow(i)) for i in range(4))
+            if view == self.view:
+                return task.again
+            self.view = view
 
             near = Point3()
             far = Point3()
             self.app.camLens.extrude(mouse_pos, near, far)
-            try:
-                if self.constraint == BlockPicker.SURFACE:
-                    for z in reversed(self.world.zlevels()):
-                        point = self.pick_point(z, near, far)
-                        picked = self.clamp_point(point, (0.5, 0.5, 0.5))
-                        if not self.world.get_block(*picked).down.is_void:
-                            self.set_picked(picked)
-                            return task.again
-
-                if self.constraint == BlockPicker.SLICE:
-                    point = self.pick_point(self.slice, near, far)
-                    picked = self.clamp_point(point, (0.5, 0.5, -0.5))
-                    self.set_picked(picked)
-                    return task.again
-            except ValueError:
-                pass
+            picked = self.pick(self.app.render.getRelativePoint(self.app.cam, near),
+                               self.app.render.getRelativePoint(self.app.cam, far))
+            if picked is not None:
+                self.set_picked(picked)
 
         return task.again
-
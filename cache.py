@@ -0,0 +1,64 @@
+"""
+An on-disk cache of numpy arrays derived from assets.
+
+Entries are .npz files in CACHE_DIR, named after the entry and a key made by
+`digest` from the contents of the source files and any parameters, so that
+changing a source makes the old entry miss. Saving an entry removes the
+stale ones of the same name.
+"""
+import glob
+import hashlib
+import os
+
+import numpy
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+
+CACHE_DIR = 'cache'
+
+notify = directNotify.newCategory('cache')
+
+
+def digest(paths, *params):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    for param in params:
+        h.update(repr(param).encode('utf-8'))
+    return h.hexdigest()
+
+
+def entry(name, key):
+    return os.path.join(CACHE_DIR, '{}-{}.npz'.format(name, key))
+
+
+def load(name, key):
+    """
+    Returns the dict of arrays saved under `name` and `key`, or None.
+    """
+    fn = entry(name, key)
+    if not os.path.exists(fn):
+        return None
+
+    try:
+        with numpy.load(fn) as data:
+            return {k: data[k] for k in data.files}
+    except Exception as e:
+        notify.warning('Ignoring broken cache entry {}: {}'.format(fn, e))
+        return None
+
+
+def save(name, key, **arrays):
+    fn = entry(name, key)
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        for stale in glob.glob(entry(name, '*')):
+            os.remove(stale)
+
+        with open(fn + '.tmp', 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(fn + '.tmp', fn)
+    except OSError as e:
+        notify.warning('Could not write cache entry {}: {}'.format(fn, e))
@@ -55,14 +55,13 @@ class Dorf(DirectObject):
             if self.z != z:
                 self.set_z(z)
 
-        b = self.world.get_block(self.x, self.y, self.z)
-        if b.is_ramp:
+        if self.world.is_ramp(self.x, self.y, self.z):
             self.node.setPos(self.x, self.y, 0.5)
         else:
             self.node.setPos(self.x, self.y, 0.0)
 
-        if b.is_block:
-            self.world.set_block(self.x, self.y, self.z, self.world.forms['Void'], 0, False)
+        if self.world.is_block(self.x, self.y, self.z):
+            self.world.set_block(self.x, self.y, self.z, self.world.form_ids['Void'], 0, False)
             self.particles.setPos(0, 0, 0)
             self.particles.start()
             for p in self.particles.getParticlesList():
@@ -82,9 +81,7 @@ class Dorf(DirectObject):
             self.dir, np = random.choice([(d, n) for d, n in ds if n in self.world])
             x, y, z = np
 
-        b = self.world.get_block(x, y, z)
-
-        if b.is_void and not b.down.is_block:
+        if self.world.is_void(x, y, z) and not self.world.is_block(x, y, z - 1):
             z -= 1
 
         self.next = (x, y, z)
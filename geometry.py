@@ -1,159 +1,558 @@
 from __future__ import division
+import heapq
 import itertools
-import struct
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy
 import panda3d.core as core
 from direct.showbase.DirectObject import DirectObject
-from direct.task.TaskManagerGlobal import taskMgr
-from direct.showbase.MessengerGlobal import messenger
 from direct.directnotify.DirectNotifyGlobal import directNotify
 
-import world
+import cache
+import mesher
+from storage import CHUNK_SIZE, CHUNK_DEPTH
+from world import FORMS_EGG
 
 
 notify = directNotify.newCategory('geometry')
 
+MESH_MODES = ('master', 'culled', 'greedy')
+
+SUBSTANCE_TEXTURES = ['dirt', 'stone']
+HIDDEN_LAYER = 0
+
+
+def triangles(indices):
+    primitive = core.GeomTriangles(core.Geom.UHStatic)
+    primitive.setIndexType(core.Geom.NTUint32)
+    array = primitive.modifyVertices()
+    array.uncleanSetNumRows(len(indices))
+    memoryview(array).cast('B')[:] = numpy.ascontiguousarray(indices, numpy.uint32).view(numpy.uint8)
+    return primitive
+
+
+def layered_format():
+    """
+    V3n3t2 plus the texture array layer and the hidden overlay flag of every vertex.
+    """
+    array = core.GeomVertexArrayFormat()
+    array.addColumn(core.InternalName.getVertex(), 3, core.Geom.NTFloat32, core.Geom.CPoint)
+    array.addColumn(core.InternalName.getNormal(), 3, core.Geom.NTFloat32, core.Geom.CNormal)
+    array.addColumn(core.InternalName.getTexcoord(), 2, core.Geom.NTFloat32, core.Geom.CTexcoord)
+    array.addColumn(core.InternalName.make('layer'), 1, core.Geom.NTFloat32, core.Geom.COther)
+    array.addColumn(core.InternalName.make('hidden'), 1, core.Geom.NTFloat32, core.Geom.COther)
+    return core.GeomVertexFormat.registerFormat(array)
+
+
+def vertex_data(name, vertices, vertexformat=None):
+    """
+    GeomVertexData holding (n, 8) float32 vertices in the V3n3t2 layout,
+    or (n, 10) ones in the layout of `layered_format`.
+    """
+    if vertexformat is None:
+        vertexformat = core.GeomVertexFormat.getV3n3t2()
+    vertexdata = core.GeomVertexData(name, vertexformat, core.Geom.UHStatic)
+    vertexdata.uncleanSetNumRows(len(vertices))
+    memoryview(vertexdata.modifyArray(0)).cast('B')[:] = numpy.ascontiguousarray(vertices, numpy.float32).view(numpy.uint8).ravel()
+    return vertexdata
+
+
+def substance_array():
+    """
+    The hidden texture and the substance textures as pages of one 2D texture array,
+    indexed by HIDDEN_LAYER and the substance ids.
+    """
+    images = []
+    for name in ['hidden'] + SUBSTANCE_TEXTURES:
+        image = core.PNMImage()
+        image.read(core.Filename('media/textures/{}.png'.format(name)))
+        images.append(image)
+
+    size = max(max(image.getXSize(), image.getYSize()) for image in images)
+    texture = core.Texture('substances')
+    texture.setup2dTextureArray(size, size, len(images), core.Texture.TUnsignedByte, core.Texture.FRgb)
+    for page, image in enumerate(images):
+        if image.getXSize() != size or image.getYSize() != size:
+            scaled = core.PNMImage(size, size, image.getNumChannels())
+            scaled.quickFilterFrom(image)
+            image = scaled
+        texture.load(image, page, 0)
+
+    texture.setMinfilter(core.Texture.FTLinearMipmapLinear)
+    texture.setAnisotropicDegree(16)
+    return texture
+
+
+def geom_node(name, vertexdata, indices):
+    geom = core.Geom(vertexdata)
+    geom.addPrimitive(triangles(indices))
+    gnode = core.GeomNode('{}-node'.format(name))
+    gnode.addGeom(geom)
+    return gnode
+
+
+def mesh_chunk(mode, layered, form, substance, hidden, padded):
+    """
+    Meshes a chunk snapshot taken by `Slice.snapshot`. Touches nothing but its arguments and the
+    shared, read-only master chunk and face table, so it is safe to run on a worker thread.
+
+    Returns (hidden indices, {substance: (vertices, indices)}, (triangles, vertices)), where
+    vertices is None for meshes indexing into the master chunk. With `layered`, everything
+    is instead merged into a single mesh under the key None, see `layer`.
+    """
+    master = Slice.master
+    visible = (substance != 0) & ~hidden
+    hidden_indices = master.gather(numpy.where(hidden, Slice.hidden_form, form), (substance != 0) & hidden)
+
+    meshes = {}
+    triangle_count = vertex_count = 0
+    if mode == 'master':
+        for s in numpy.unique(substance[visible]):
+            indices = master.gather(form, visible & (substance == s))
+            meshes[int(s)] = (None, indices)
+            triangle_count += len(indices) // 3
+            vertex_count += len(numpy.unique(indices))
+    else:
+        meshes = Slice.faces.mesh(padded, substance, hidden, merge=mode == 'greedy')
+        for vertices, indices in meshes.values():
+            triangle_count += len(indices) // 3
+            vertex_count += len(vertices)
+
+    if layered:
+        return None, {None: layer(hidden_indices, meshes)}, (triangle_count, vertex_count)
+    return hidden_indices, meshes, (triangle_count, vertex_count)
+
+
+def layer(hidden_indices, meshes):
+    """
+    Merges the hidden overlay and the substance meshes of a chunk into one mesh for the texture array,
+    tagging every vertex with its layer (the substance, or HIDDEN_LAYER) and whether it is hidden.
+    """
+    parts = [(HIDDEN_LAYER, 1.0, None, hidden_indices)]
+    parts.extend((s, 0.0, vertices, indices) for s, (vertices, indices) in sorted(meshes.items()))
+
+    vertices, indices, count = [], [], 0
+    for page, flag, v, i in parts:
+        if v is None:
+            used, i = numpy.unique(i, return_inverse=True)
+            v = Slice.master.vertices[used]
+
+        tagged = numpy.empty((len(v), 10), numpy.float32)
+        tagged[:, :8] = v
+        tagged[:, 8] = page
+        tagged[:, 9] = flag
+        vertices.append(tagged)
+        indices.append(i.ravel().astype(numpy.uint32) + count)
+        count += len(v)
+
+    return numpy.concatenate(vertices), numpy.concatenate(indices)
+
+
+class MeshWorkers(object):
+    """
+    A pool of threads meshing chunk snapshots. Finished meshes wait in `results`
+    for the main thread, which alone touches the scene graph.
+    """
+
+    def __init__(self, count=2):
+        self.executor = ThreadPoolExecutor(count)
+        self.results = queue.Queue()
+
+    def submit(self, slice, key, version, snapshot):
+        self.executor.submit(self.run, slice, key, version, snapshot)
+
+    def run(self, slice, key, version, snapshot):
+        try:
+            self.results.put((slice, key, version, mesh_chunk(*snapshot)))
+        except Exception as e:
+            notify.warning('Meshing chunk {} of slice {} failed: {}'.format(key, slice.z, e))
+
+    def collect(self):
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class ChunkScheduler(object):
+    """
+    Decides which dirty chunks are meshed, and in what order.
+
+    Dirty (z, cx, cy) chunks wait in a heap ordered by their horizontal distance to the camera
+    in chunks plus their distance to the current slice in levels. Every frame finished meshes
+    are attached first, then the nearest chunks are sent to the workers, until `budget`
+    milliseconds of main-thread time are spent. Chunks of hidden slices and of `capped` chunk columns,
+    which are drawn at a lower level of detail, wait until they are shown.
+    """
+
+    def __init__(self, node, slices, workers, camera=None, budget=4.0):
+        self.node = node
+        self.slices = slices
+        self.workers = workers
+        self.camera = camera
+        self.budget = budget
+
+        self.heap = []
+        self.queued = set()
+        self.waiting = set()
+        self.capped = set()
+        self.current_slice = 0
+        self.focus = None
+
+        self.spent = 0.0
+        self.submitted = 0
+        self.attached = 0
+
+    def schedule(self, z, cx, cy):
+        key = (z, cx, cy)
+        if key not in self.queued:
+            self.queued.add(key)
+            heapq.heappush(self.heap, (self.priority(key, self.focus), key))
+
+    def set_slice(self, current_slice):
+        self.current_slice = current_slice
+        self.wake()
+
+    def wake(self):
+        for key in self.waiting:
+            self.schedule(*key)
+        self.waiting = set()
+
+    def camera_position(self):
+        if self.camera is None:
+            return None
+        pos = self.camera.getPos(self.node)
+        return int(pos.x) // CHUNK_SIZE, int(pos.y) // CHUNK_SIZE
+
+    def priority(self, key, focus):
+        z, cx, cy = key
+        priority = abs(z - self.current_slice)
+        if focus is not None and focus[0] is not None:
+            px, py = focus[0]
+            priority += ((cx - px) ** 2 + (cy - py) ** 2) ** 0.5
+        return priority
+
+    def reorder(self):
+        focus = (self.camera_position(), self.current_slice)
+        if focus != self.focus:
+            self.focus = focus
+            self.heap = [(self.priority(key, focus), key) for key in self.queued]
+            heapq.heapify(self.heap)
+
+    def run(self, task):
+        start = time.perf_counter()
+        deadline = start + self.budget / 1000.0
+        self.attached = self.submitted = 0
+
+        for slice, (cx, cy), version, mesh in self.workers.collect():
+            if version == slice.versions.get((cx, cy), 0):
+                slice.attach(cx, cy, mesh)
+                self.attached += 1
+            if time.perf_counter() > deadline:
+                break
+
+        self.reorder()
+        while self.heap and time.perf_counter() < deadline:
+            _, key = heapq.heappop(self.heap)
+            self.queued.discard(key)
+
+            z, cx, cy = key
+            if self.slices[z].isHidden() or (cx, cy) in self.capped:
+                self.waiting.add(key)
+                continue
 
-class GeomBuilder(object):
-    def __init__(self, name, master):
-        self.name = name
-        self.master = master
-        self.primitive = core.GeomTriangles(core.Geom.UHStatic)
-        self.primitive.setIndexType(core.Geom.NTUint32)
-        self.indices = []
+            self.slices[z].request(cx, cy)
+            self.submitted += 1
 
-    def add_block(self, x, y, form, hidden):
-        if hidden:
-            form = world.Block.FORMS['Hidden']
-        else:
-            form = form
-        offset = self.master.index_offset(x, y, form)
-        self.indices.extend([i + offset for i in form.indices])
-
-    def build(self):
-        array = self.primitive.modifyVertices()
-        fmt = array.getArrayFormat().getFormatString()
-        data = struct.pack(fmt * len(self.indices), *self.indices)
-        array.modifyHandle().setData(data)
-        geom = core.Geom(self.master.vertexdata)
-        geom.addPrimitive(self.primitive)
-        gnode = core.GeomNode('{}-node'.format(self.name))
-        gnode.addGeom(geom)
-        return gnode
+        self.spent = (time.perf_counter() - start) * 1000.0
+        return task.cont
+
+    def stats(self):
+        return {
+            'queued': len(self.queued),
+            'waiting': len(self.waiting),
+            'meshed': self.workers.results.qsize(),
+            'spent': self.spent,
+            'budget': self.budget,
+            'submitted': self.submitted,
+            'attached': self.attached,
+        }
+
+
+class ChunkVisibility(object):
+    """
+    Decides every frame which attached chunks of the shown slices are drawn.
+
+    Chunks are boxes of one cell by CHUNK_SIZE square and are tested against the camera frustum
+    all at once. In explore mode, chunks lying below the solid surface of their whole chunk column
+    and the cells around it are occluded while the camera is above that column. Culled chunks are
+    stashed, so they cost nothing in the cull traversal.
+    """
+
+    def __init__(self, world, node, camera=None):
+        self.world = world
+        self.node = node
+        self.camera = camera
+        self.enabled = True
+
+        nx, ny = world.blocks.grid_shape[:2]
+        self.culled = numpy.zeros((world.depth, ny, nx), numpy.bool_)
+        self.cover = None
+        self.counts = {'drawn': 0, 'outside': 0, 'occluded': 0}
+
+        size = CHUNK_SIZE
+        self.x0 = numpy.arange(nx)[None, None, :] * size - 0.5
+        self.y0 = numpy.arange(ny)[None, :, None] * size - 0.5
+        self.z0 = numpy.arange(world.depth)[:, None, None]
+
+    def invalidate(self):
+        self.cover = None
+
+    def coverage(self):
+        """
+        The lowest and highest solid surface over every chunk column and the cells around it, as (ny, nx) arrays.
+        """
+        if self.cover is None:
+            size = CHUNK_SIZE
+            ny, nx = self.culled.shape[1:]
+            heights = self.world.heightmap(solid=True)
+            h, w = heights.shape
+            # Clipped edge chunks repeat the last row and column, which changes no minimum or maximum
+            padded = numpy.pad(heights, ((1, ny * size - h + 1), (1, nx * size - w + 1)), mode='edge')
+            low = padded[1:-1, 1:-1].copy()
+            high = low.copy()
+            for dy, dx in itertools.product(range(3), range(3)):
+                neighbour = padded[dy:dy + ny * size, dx:dx + nx * size]
+                numpy.minimum(low, neighbour, out=low)
+                numpy.maximum(high, neighbour, out=high)
+            self.cover = (low.reshape(ny, size, nx, size).min(axis=(1, 3)),
+                          high.reshape(ny, size, nx, size).max(axis=(1, 3)))
+        return self.cover
+
+    def in_frustum(self):
+        """
+        Whether the box of every (z, cy, cx) chunk is at least partly inside the camera frustum.
+        """
+        bounds = self.camera.node().getLens().makeBounds()
+        bounds.xform(self.camera.getMat(self.node))
+
+        size = CHUNK_SIZE
+        inside = numpy.ones(self.culled.shape, numpy.bool_)
+        for i in range(bounds.getNumPlanes()):
+            a, b, c, d = bounds.getPlane(i)
+            # The corner farthest inside the plane, whose normal points out of the frustum
+            nearest = (
+                a * (self.x0 + (size if a < 0 else 0)) +
+                b * (self.y0 + (size if b < 0 else 0)) +
+                c * (self.z0 + (1 if c < 0 else 0)) + d
+            )
+            inside &= nearest <= 0
+        return inside
+
+    def update(self, slices, capped, explore):
+        """
+        Stashes the chunks culled this frame and unstashes the ones that came back into view.
+        """
+        present = numpy.zeros(self.culled.shape, numpy.bool_)
+        for s in slices:
+            if s is not None and not s.isHidden():
+                present[s.z] = s.attached
+        for cx, cy in capped:
+            present[:, cy, cx] = False
+
+        outside = numpy.zeros_like(present)
+        occluded = numpy.zeros_like(present)
+        if self.enabled and self.camera is not None:
+            outside = present & ~self.in_frustum()
+            if explore:
+                low, high = self.coverage()
+                above = self.camera.getPos(self.node).z > high + 1
+                occluded = present & ~outside & (self.z0 < low) & above
+
+        culled = outside | occluded
+        self.counts = {
+            'drawn': int((present & ~culled).sum()),
+            'outside': int(outside.sum()),
+            'occluded': int(occluded.sum()),
+        }
+
+        # Chunks that are gone or hidden keep their state until they are shown again
+        changed = present & (culled != self.culled)
+        for z, cy, cx in zip(*numpy.nonzero(changed)):
+            slices[z].set_culled(int(cx), int(cy), culled[z, cy, cx])
+        self.culled[changed] = culled[changed]
+
+    def stats(self, slices):
+        geoms = 0
+        for s in slices:
+            if s is not None and not s.isHidden():
+                for (cx, cy), nps in s.chunks.items():
+                    if not self.culled[s.z, cy, cx]:
+                        geoms += sum(1 for np in nps if not np.isHidden())
+        return dict(self.counts, geoms=geoms)
 
 
 class MasterChunk(object):
-    def __init__(self, size, forms):
+    """
+    The vertices of every form at every cell of a chunk, so that chunk meshes are only indices into it.
+    Cells follow each other x-major, and each holds the vertices of all forms in id order.
+    """
+
+    def __init__(self, size, forms, cache_key=None):
         notify.info('Building the Master Chunk')
         self.size = size
+        self.forms = forms
         self.vertexformat = core.GeomVertexFormat.getV3n3t2()
-        self.vertexdata = core.GeomVertexData('MasterChunk', self.vertexformat, core.Geom.UHStatic)
-
-        vertex_writer = core.GeomVertexWriter(self.vertexdata, 'vertex')
-        normal_writer = core.GeomVertexWriter(self.vertexdata, 'normal')
-        texcoord_writer = core.GeomVertexWriter(self.vertexdata, 'texcoord')
-
-        self.index_offsets = {}
 
-        i = 0
-        for x, y in itertools.product(range(self.size), range(self.size)):
-            for form in forms:
-                self.index_offsets[(x, y, form.name)] = i
-                for v, n, t in form.vertices:
-                    vertex_writer.addData3f(v[0] + x, v[1] + y, v[2])
-                    normal_writer.addData3f(*n)
-                    texcoord_writer.addData2f(*t)
-                i += form.num_vertices
+        counts = numpy.array([form.num_vertices for form in forms])
+        self.cell_vertices = int(counts.sum())
+        self.form_offsets = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]]).astype(numpy.uint32)
+        self.templates = [numpy.array(form.indices, numpy.uint32) for form in forms]
+
+        cells = numpy.arange(size * size, dtype=numpy.uint32).reshape(size, size).T * self.cell_vertices
+        self.offsets = cells[None] + self.form_offsets[:, None, None]
+
+        vertices = None
+        if cache_key is not None:
+            cached = cache.load('master-chunk', cache_key)
+            vertices = cached and cached['vertices']
+        if vertices is None:
+            vertices = self.build_vertices()
+            if cache_key is not None:
+                cache.save('master-chunk', cache_key, vertices=vertices)
+        self.vertices = vertices
+        self.vertexdata = vertex_data('MasterChunk', vertices)
 
         notify.info('Master Chunk building complete')
 
-    def index_offset(self, x, y, form):
-        return self.index_offsets[(x, y, form.name)]
+    def build_vertices(self):
+        template = numpy.array([tuple(v) + tuple(n) + tuple(t)
+                                for form in self.forms for v, n, t in form.vertices], numpy.float32)
+        x, y = numpy.divmod(numpy.arange(self.size * self.size), self.size)
+        vertices = template[None].repeat(self.size * self.size, axis=0)
+        vertices[:, :, 0] += x[:, None]
+        vertices[:, :, 1] += y[:, None]
+        return vertices.reshape(-1, 8)
+
+    def gather(self, form, mask):
+        """
+        The index buffer for every cell of a (y, x) array of form ids where `mask` is set,
+        one form template at a time.
+        """
+        h, w = form.shape
+        offsets = self.offsets[:, :h, :w]
+        indices = []
+        for f in numpy.unique(form[mask]):
+            template = self.templates[f]
+            if len(template):
+                indices.append((offsets[f][mask & (form == f)][:, None] + template).ravel())
+        return numpy.concatenate(indices) if indices else numpy.zeros(0, numpy.uint32)
 
 
 class Slice(core.NodePath):
-    chunk_size = 32
+    chunk_size = CHUNK_SIZE
     master = None
-
-    def __init__(self, world, z):
+    faces = None
+    hidden_form = None
+    substances = None
+    hiddentexture = None
+    mesh_mode = 'master'
+    layered = None
+    substance_array = None
+    show_stale_chunks = False
+
+    def __init__(self, world, z, scheduler, visibility):
         core.NodePath.__init__(self, 'slice-{}'.format(z))
 
-        if Slice.master is None:
-            Slice.master = MasterChunk(self.chunk_size, world.forms.values())
-
         self.world = world
         self.z = z
+        self.scheduler = scheduler
+        self.visibility = visibility
 
         self.chunks = {}
         self.hidden_chunks = {}
+        self.stats = {}
+        self.memory = {}
+        self.attached = numpy.zeros(visibility.culled.shape[1:], numpy.bool_)
 
         self.setPos(0, 0, z)
 
-        self.substances = [None] + [
-            loader.loadTexture('media/textures/{}.png'.format(name),
-                               anisotropicDegree=16,
-                               minfilter=core.Texture.FTLinearMipmapLinear)
-            for name in ['dirt', 'stone']
-        ]
-
-        self.hiddentexture = loader.loadTexture('media/textures/hidden.png',
-                                                anisotropicDegree=16,
-                                                minfilter=core.Texture.FTLinearMipmapLinear)
-        self.hiddentexture.setWrapU(core.Texture.WMClamp)
-        self.hiddentexture.setWrapV(core.Texture.WMClamp)
-
-        self.show_stale_chunks = False
-
-        self.updates = set()
+        self.versions = {}
         self.first_update_done = False
-
-        self.task = taskMgr.add(self.perform_updates, 'Slice update')
-
-        messenger.accept('console-command', self, self.command)
-
-    def command(self, args):
-        args = list(args)
-        cmd = args.pop(0)
-        if cmd == 'show-stale-chunks':
-            self.show_stale_chunks = not self.show_stale_chunks
+        self.hidden_shown = False
+        self.setShaderInput('show_hidden', 0.0)
 
     def update_all(self):
         for cx, cy in itertools.product(range(self.world.width // self.chunk_size), range(self.world.height // self.chunk_size)):
-            self.build_chunk(cx, cy)
+            self.scheduler.schedule(self.z, cx, cy)
 
     def first_update(self):
         if not self.first_update_done:
             self.update_all()
             self.first_update_done = True
 
-
     def destroy(self):
-        messenger.ignoreAll(self)
         self.detachNode()
-        taskMgr.remove(self.task)
-
-    def build_chunk(self, cx, cy):
-        hbuilder = GeomBuilder('slice-{}-hidden'.format(self.z), self.master)
-        builders = {}
 
-        chunk_size = self.chunk_size
-        block_getter = self.world.get_raw
-
-        for x, y in itertools.product(range(chunk_size), range(chunk_size)):
-            form, substance, hidden = block_getter(cx * chunk_size + x, cy * chunk_size + y, self.z)
-            if not substance:
-                continue
+    @property
+    def nbytes(self):
+        return sum(self.memory.values())
+
+    def evict(self):
+        """
+        Drops all geometry; the next `first_update` builds it again.
+        Meshes still being built are discarded when they arrive.
+        """
+        for key in set(self.chunks) | set(self.versions):
+            self.versions[key] = self.versions.get(key, 0) + 1
+        for nps in self.chunks.values():
+            for np in nps:
+                np.removeNode()
+        for hnp in self.hidden_chunks.values():
+            hnp.removeNode()
 
-            if hidden:
-                builder = hbuilder
-            else:
-                if substance not in builders:
-                    builders[substance] = GeomBuilder('slice-{}-geom-{}'.format(self.z, substance), self.master)
-                builder = builders[substance]
+        self.chunks = {}
+        self.hidden_chunks = {}
+        self.stats = {}
+        self.memory = {}
+        self.attached[:] = False
+        self.first_update_done = False
 
-            builder.add_block(x, y, form, hidden)
+    def snapshot(self, cx, cy):
+        """
+        Copies everything meshing a chunk needs out of the world, as arguments for `mesh_chunk`.
+        """
+        chunk_size = self.chunk_size
+        region = self.world.region(cx * chunk_size, (cx + 1) * chunk_size,
+                                   cy * chunk_size, (cy + 1) * chunk_size,
+                                   self.z, self.z + 1)
+
+        padded = None
+        if self.mesh_mode != 'master':
+            padded = self.world.padded(lambda *box: self.world.blocks.read(*box)[0],
+                                       region.x0, region.x1, region.y0, region.y1, self.z, self.z + 1)[1]
+        layered = self.layered is not None
+        return self.mesh_mode, layered, region.form[0], region.substance[0], region.hidden[0], padded
+
+    def request(self, cx, cy):
+        """
+        Queues the chunk for meshing on the worker threads.
+        """
+        self.scheduler.workers.submit(self, (cx, cy), self.versions.get((cx, cy), 0), self.snapshot(cx, cy))
+
+    def attach(self, cx, cy, mesh):
+        """
+        Replaces the chunk's nodes with ones built from a `mesh_chunk` result.
+        """
+        hidden_indices, meshes, stats = mesh
+        nbytes = 0
 
-        hide = True
         old = self.chunks.get((cx, cy))
         oldh = self.hidden_chunks.get((cx, cy))
 
@@ -161,30 +560,68 @@ class Slice(core.NodePath):
             for n in old:
                 n.detachNode()
         if oldh:
-            hide = oldh.isHidden()
             oldh.detachNode()
 
         nps = []
-        for s, b in builders.items():
-            np = self.attachNewNode(b.build())
-            np.setPos(cx * chunk_size, cy * chunk_size, 0)
-            np.setTexture(self.substances[s])
+        for s, (vertices, indices) in meshes.items():
+            if s is None:
+                name = 'slice-{}-layered'.format(self.z)
+                vertexdata = vertex_data(name, vertices, self.layered)
+                texture = self.substance_array
+            else:
+                name = 'slice-{}-geom-{}'.format(self.z, s)
+                vertexdata = self.master.vertexdata if vertices is None else vertex_data(name, vertices)
+                texture = self.substances[s]
+            nbytes += indices.nbytes + (0 if vertices is None else vertices.nbytes)
+            np = self.place(geom_node(name, vertexdata, indices), cx, cy)
+            np.setTexture(texture)
+            if (cx, cy) in self.scheduler.capped:
+                np.hide()
             nps.append(np)
 
-        hnp = self.attachNewNode(hbuilder.build())
-        hnp.setPos(cx * chunk_size, cy * chunk_size, 0)
-        hnp.setTexture(self.hiddentexture)
-        if hide:
-            hnp.hide()
-        else:
-            hnp.show()
-
         self.chunks[(cx, cy)] = nps
-        self.hidden_chunks[(cx, cy)] = hnp
+        if hidden_indices is None:
+            self.hidden_chunks.pop((cx, cy), None)
+        else:
+            nbytes += hidden_indices.nbytes
+            hnp = self.place(geom_node('slice-{}-hidden'.format(self.z), self.master.vertexdata, hidden_indices), cx, cy)
+            hnp.setTexture(self.hiddentexture)
+            if not self.hidden_shown or (cx, cy) in self.scheduler.capped:
+                hnp.hide()
+            self.hidden_chunks[(cx, cy)] = hnp
+        self.stats[(cx, cy)] = stats
+        self.memory[(cx, cy)] = nbytes
+        self.attached[cy, cx] = bool(nps) or (hidden_indices is not None and len(hidden_indices) > 0)
+
+    def place(self, gnode, cx, cy):
+        """
+        Attaches a chunk node at its position, with a box the size of the chunk as its bounds,
+        stashed if the chunk is culled.
+        """
+        chunk_size = self.chunk_size
+        gnode.setBounds(core.BoundingBox(core.Point3(-0.5, -0.5, 0), core.Point3(chunk_size - 0.5, chunk_size - 0.5, 1)))
+        gnode.setBoundsType(core.BoundingVolume.BT_box)
+        gnode.setFinal(True)
+
+        np = self.attachNewNode(gnode)
+        np.setPos(cx * chunk_size, cy * chunk_size, 0)
+        if self.visibility.culled[self.z, cy, cx]:
+            np.stash()
+        return np
+
+    def set_culled(self, cx, cy, culled):
+        nps = self.chunks.get((cx, cy), [])
+        hnp = self.hidden_chunks.get((cx, cy))
+        for np in nps + ([hnp] if hnp is not None else []):
+            if culled:
+                np.stash()
+            else:
+                np.unstash()
 
-    def update(self, x, y):
-        cx, cy = x // self.chunk_size, y // self.chunk_size
-        self.updates.add((cx, cy))
+    def update(self, cx, cy):
+        self.versions[(cx, cy)] = self.versions.get((cx, cy), 0) + 1
+        if self.first_update_done:
+            self.scheduler.schedule(self.z, cx, cy)
 
         if self.show_stale_chunks:
             old = self.chunks.get((cx, cy))
@@ -197,32 +634,77 @@ class Slice(core.NodePath):
                 oldh.setColorScale(1.0, 0.5, 0.5, 1.0)
 
     def hide_hidden(self):
+        self.hidden_shown = False
+        self.setShaderInput('show_hidden', 0.0)
         for c in self.hidden_chunks.values():
             c.hide()
 
     def show_hidden(self):
-        for c in self.hidden_chunks.values():
-            c.show()
+        self.hidden_shown = True
+        self.setShaderInput('show_hidden', 1.0)
+        for key, c in self.hidden_chunks.items():
+            if key not in self.scheduler.capped:
+                c.show()
+
+    def set_detail(self, cx, cy, full):
+        """
+        Shows the chunk, or hides it while its column is drawn as a cap.
+        """
+        for np in self.chunks.get((cx, cy), []):
+            if full:
+                np.show()
+            else:
+                np.hide()
+        hnp = self.hidden_chunks.get((cx, cy))
+        if hnp is not None:
+            if full and self.hidden_shown:
+                hnp.show()
+            else:
+                hnp.hide()
 
-    def perform_updates(self, task):
-        if self.isHidden():
-            return task.cont
 
-        if self.updates:
-            cx, cy = self.updates.pop()
-            self.build_chunk(cx, cy)
+class WorldGeometry(DirectObject):
+    """
+    The slices of the world, created the first time they are needed.
 
-        return task.again
+    A slice is meshed when it is first shown. When the geometry of all slices grows past
+    `memory_cap` bytes, hidden slices are evicted, farthest from the current level first,
+    and meshed again when shown.
 
+    In explore mode, chunk columns farther than `lod_distance` from the camera are drawn as a cap
+    of their surface instead of a stack of slices, until the camera comes near or they are edited.
+    """
 
-class WorldGeometry(DirectObject):
-    def __init__(self, world):
+    def __init__(self, world, camera=None, budget=4.0, memory_cap=64 * 1024 * 1024, lod_distance=96.0):
         notify.info('Initializing world geometry')
 
         self.world = world
+
+        # Shared by every slice and by the caps, which may be built before any slice exists
+        if Slice.master is None:
+            Slice.master = MasterChunk(Slice.chunk_size, world.registry.forms,
+                                       cache.digest([FORMS_EGG], Slice.chunk_size))
+        if Slice.faces is None:
+            Slice.faces = mesher.FaceTable(world.registry)
+        Slice.hidden_form = world.form_ids['Hidden']
+        if Slice.substances is None:
+            Slice.substances = [None] + [
+                loader.loadTexture('media/textures/{}.png'.format(name),
+                                   anisotropicDegree=16,
+                                   minfilter=core.Texture.FTLinearMipmapLinear)
+                for name in SUBSTANCE_TEXTURES
+            ]
+        if Slice.hiddentexture is None:
+            Slice.hiddentexture = loader.loadTexture('media/textures/hidden.png',
+                                                     anisotropicDegree=16,
+                                                     minfilter=core.Texture.FTLinearMipmapLinear)
+            Slice.hiddentexture.setWrapU(core.Texture.WMClamp)
+            Slice.hiddentexture.setWrapV(core.Texture.WMClamp)
+
         self.node = core.NodePath('world')
-        shader = core.Shader.load(core.Shader.SLGLSL, 'media/shaders/vertex.glsl', 'media/shaders/fragment.glsl')
-        self.node.setShader(shader)
+        self.shader = core.Shader.load(core.Shader.SLGLSL, 'media/shaders/vertex.glsl', 'media/shaders/fragment.glsl')
+        self.array_shader = None
+        self.node.setShader(self.shader)
         self.node.setShaderInput('color_scale', 1.0)
 
         self.bordertexture = loader.loadTexture('media/textures/border.png',
@@ -230,70 +712,335 @@ class WorldGeometry(DirectObject):
                                                 minfilter=core.Texture.FTLinearMipmapLinear)
         self.node.setShaderInput('border_texture', self.bordertexture)
 
-        self.slices = []
+        self.caps = self.node.attachNewNode('caps')
+        self.caps.setShader(self.shader)
+        self.cap_nodes = {}
+        self.lod_distance = lod_distance
+        self.explore = False
+        self.edited = set()
 
-        for z in range(self.world.depth):
-            slice = Slice(self.world, z)
-            slice.reparentTo(self.node)
-            self.slices.append(slice)
+        self.slices = [None] * self.world.depth
+        self.workers = MeshWorkers()
+        self.scheduler = ChunkScheduler(self.node, self.slices, self.workers, camera, budget)
+        self.visibility = ChunkVisibility(self.world, self.node, camera)
+        self.memory_cap = memory_cap
+        self.current_slice = 0
 
-            for x, y in self.world.columns():
-                f, s, h = self.world.get_raw(x, y, z)
-                if s and not h:
-                    slice.update_all()
-                    break
+        self.content = set()
+        self.scan_content()
 
         self.accept('slice-changed', self.slice_changed)
-        self.accept('block-update', self.block_update)
+        self.accept('blocks-updated', self.blocks_updated)
         self.accept('entity-z-change', self.reparent_entity)
         self.accept('designation-add', self.designation)
+        self.accept('console-command', self.command)
+        self.addTask(self.scheduler.run, 'Chunk scheduler')
+        self.addTask(self.update_lod, 'Slice LOD')
+        self.addTask(self.update_visibility, 'Chunk culling')
 
         notify.info('Initializing world geometry complete')
 
+    def slice(self, z):
+        """
+        The slice at level z, created on first use.
+        """
+        s = self.slices[z]
+        if s is None:
+            s = self.slices[z] = Slice(self.world, z, self.scheduler, self.visibility)
+            s.reparentTo(self.node)
+            s.hide()
+        return s
+
+    def materialized(self):
+        return [s for s in self.slices if s is not None]
+
+    def scan_content(self):
+        """
+        Finds the levels with visible blocks, which explore mode shows. Uniform chunks are judged by
+        their value and chunks not loaded yet count as visible throughout, so no chunk is loaded.
+        """
+        self.content = set()
+        blocks = self.world.blocks
+        for key in blocks.chunk_keys():
+            cz = key[2]
+            levels = range(cz * CHUNK_DEPTH, min((cz + 1) * CHUNK_DEPTH, self.world.depth))
+            if self.content.issuperset(levels):
+                continue
+
+            value = blocks.uniform_value(key)
+            if value is not None:
+                _, substance, hidden = value
+                if substance != 0 and not hidden:
+                    self.content.update(levels)
+            elif blocks.is_pending(key):
+                self.content.update(levels)
+            else:
+                c = blocks.chunk(key)
+                visible = (c.substance != 0) & ~c.hidden
+                self.content.update(levels[0] + int(z) for z in numpy.flatnonzero(visible.any(axis=(1, 2))))
+
+    @property
+    def nbytes(self):
+        return sum(s.nbytes for s in self.materialized())
+
+    def evict(self):
+        total = self.nbytes
+        if total <= self.memory_cap:
+            return
+
+        candidates = [s for s in self.materialized() if s.isHidden() and s.memory]
+        candidates.sort(key=lambda s: abs(s.z - self.current_slice), reverse=True)
+        for s in candidates:
+            if total <= self.memory_cap:
+                break
+            total -= s.nbytes
+            s.evict()
+
+    def command(self, args):
+        args = list(args)
+        cmd = args.pop(0)
+
+        if cmd == 'mesh-mode':
+            mode = args.pop(0)
+            if mode not in MESH_MODES:
+                notify.warning('Unknown mesh mode {}, expected one of {}'.format(mode, ', '.join(MESH_MODES)))
+                return
+
+            Slice.mesh_mode = mode
+            for s in self.materialized():
+                for cx, cy in s.chunks:
+                    s.update(cx, cy)
+        if cmd == 'mesh-stats':
+            slices = [self.slice(int(args.pop(0)))] if args else self.materialized()
+            chunks = [(s.z, key, stats) for s in slices for key, stats in sorted(s.stats.items())]
+            if len(slices) == 1:
+                for z, (cx, cy), (tris, verts) in chunks:
+                    notify.info('chunk {} {} {}: {} triangles, {} vertices'.format(z, cx, cy, tris, verts))
+            notify.info('{} mode, {} chunks: {} triangles, {} vertices'.format(
+                Slice.mesh_mode, len(chunks),
+                sum(tris for _, _, (tris, verts) in chunks),
+                sum(verts for _, _, (tris, verts) in chunks),
+            ))
+        if cmd == 'texture-array':
+            enable = Slice.layered is None
+            if args:
+                enable = args.pop(0) != 'off'
+            self.set_texture_array(enable)
+        if cmd == 'lod':
+            if args:
+                arg = args.pop(0)
+                self.lod_distance = None if arg == 'off' else float(arg)
+            notify.info('LOD distance {}: {} of {} chunk columns capped'.format(
+                self.lod_distance, len(self.scheduler.capped), len(self.columns()[0])))
+        if cmd == 'culling':
+            if args:
+                self.visibility.enabled = args.pop(0) != 'off'
+            notify.info('Culling {}: {drawn} chunks drawn ({geoms} geoms), {outside} outside the view, '
+                        '{occluded} occluded, {capped} columns capped'.format(
+                            'on' if self.visibility.enabled else 'off',
+                            capped=len(self.scheduler.capped),
+                            **self.visibility.stats(self.slices)))
+        if cmd == 'chunk-queue':
+            notify.info(
+                '{queued} chunks queued, {waiting} waiting for hidden slices, {meshed} meshed and not attached; '
+                'last frame spent {spent:.2f} of {budget} ms: {submitted} sent to workers, {attached} attached'.format(
+                    **self.scheduler.stats())
+            )
+        if cmd == 'chunk-budget':
+            self.scheduler.budget = float(args.pop(0))
+        if cmd == 'show-stale-chunks':
+            Slice.show_stale_chunks = not Slice.show_stale_chunks
+        if cmd == 'geometry-memory':
+            if args:
+                self.memory_cap = int(float(args.pop(0)) * 1024 * 1024)
+                self.evict()
+            slices = self.materialized()
+            notify.info('{} slices created, {} with geometry: {} bytes, cap {} bytes'.format(
+                len(slices), sum(1 for s in slices if s.memory), self.nbytes, self.memory_cap))
+
+    def set_texture_array(self, enable):
+        """
+        Switches between one geom per substance plus a hidden overlay per chunk, and one geom per chunk
+        textured from the substance texture array.
+        """
+        if enable == (Slice.layered is not None):
+            return
+
+        if enable:
+            if self.array_shader is None:
+                self.array_shader = core.Shader.load(core.Shader.SLGLSL,
+                                                     'media/shaders/array_vertex.glsl',
+                                                     'media/shaders/array_fragment.glsl')
+                Slice.substance_array = substance_array()
+            Slice.layered = layered_format()
+            self.node.setShader(self.array_shader)
+        else:
+            Slice.layered = None
+            self.node.setShader(self.shader)
+
+        for s in self.materialized():
+            for cx, cy in s.chunks:
+                s.update(cx, cy)
+
+    def columns(self):
+        """
+        The (cx, cy) chunk columns of the world, and the x and y of their centres.
+        """
+        cxs, cys = numpy.meshgrid(numpy.arange(-(-self.world.width // CHUNK_SIZE)),
+                                  numpy.arange(-(-self.world.height // CHUNK_SIZE)))
+        keys = list(zip(cxs.ravel().tolist(), cys.ravel().tolist()))
+        return keys, (cxs.ravel() + 0.5) * CHUNK_SIZE, (cys.ravel() + 0.5) * CHUNK_SIZE
+
+    def update_lod(self, task):
+        capped = set()
+        camera = self.scheduler.camera
+        if self.explore and self.lod_distance is not None and camera is not None:
+            pos = camera.getPos(self.node)
+            keys, xs, ys = self.columns()
+            distance = numpy.hypot(xs - pos.x, ys - pos.y)
+            far = distance > self.lod_distance
+            # Capped columns return to full detail a little closer in, so that they do not flicker at the edge
+            keep = distance > self.lod_distance * 0.9
+
+            for key, f, k in zip(keys, far.tolist(), keep.tolist()):
+                if not k:
+                    self.edited.discard(key)
+                if key not in self.edited and (f or (k and key in self.scheduler.capped)):
+                    capped.add(key)
+
+        self.set_capped(capped)
+        return task.cont
+
+    def update_visibility(self, task):
+        self.visibility.update(self.slices, self.scheduler.capped, self.explore)
+        return task.cont
+
+    def set_capped(self, capped):
+        """
+        Draws the given chunk columns as caps and the others at full detail. Caps are built within the
+        scheduler's budget; the columns left over stay at full detail until a later frame.
+        """
+        old = self.scheduler.capped
+        if capped == old:
+            return
+
+        deadline = time.perf_counter() + self.scheduler.budget / 1000.0
+        for cx, cy in capped - old:
+            if (cx, cy) not in self.cap_nodes:
+                if time.perf_counter() > deadline:
+                    capped.discard((cx, cy))
+                    continue
+                self.build_cap(cx, cy)
+            for np in self.cap_nodes[(cx, cy)]:
+                np.show()
+            for s in self.materialized():
+                s.set_detail(cx, cy, False)
+
+        for cx, cy in old - capped:
+            for np in self.cap_nodes.get((cx, cy), []):
+                np.hide()
+            for s in self.materialized():
+                s.set_detail(cx, cy, True)
+
+        self.scheduler.capped = capped
+        self.scheduler.wake()
+
+    def build_cap(self, cx, cy):
+        x0, x1 = cx * CHUNK_SIZE, min((cx + 1) * CHUNK_SIZE, self.world.width)
+        y0, y1 = cy * CHUNK_SIZE, min((cy + 1) * CHUNK_SIZE, self.world.height)
+
+        # The heights of the column and the cells around it, none outside the world
+        heights = numpy.full((y1 - y0 + 2, x1 - x0 + 2), -1, numpy.int16)
+        wy0, wx0 = max(y0 - 1, 0), max(x0 - 1, 0)
+        window = self.world.heightmap(False, wx0, x1 + 1, wy0, y1 + 1)
+        heights[wy0 - y0 + 1:wy0 - y0 + 1 + window.shape[0], wx0 - x0 + 1:wx0 - x0 + 1 + window.shape[1]] = window
+
+        region = self.world.region(x0, x1, y0, y1, 0, self.world.depth)
+        top = numpy.maximum(heights[1:-1, 1:-1], 0)[None]
+        substance = numpy.take_along_axis(region.substance, top, axis=0)[0]
+        heights[1:-1, 1:-1][substance == 0] = -1
+
+        nps = []
+        for s, (vertices, indices) in Slice.faces.cap(heights, substance).items():
+            name = 'cap-{}-{}-{}'.format(cx, cy, s)
+            np = self.caps.attachNewNode(geom_node(name, vertex_data(name, vertices), indices))
+            np.setPos(x0, y0, 0)
+            np.setTexture(Slice.substances[s])
+            np.hide()
+            nps.append(np)
+        self.cap_nodes[(cx, cy)] = nps
+
+    def drop_cap(self, cx, cy):
+        for np in self.cap_nodes.pop((cx, cy), []):
+            np.removeNode()
+
     def destroy(self):
-        for s in self.slices:
+        for s in self.materialized():
             s.destroy()
+        self.workers.shutdown()
+        self.removeAllTasks()
         self.ignoreAll()
         self.node.detachNode()
 
     def slice_changed(self, current_slice, explore):
-        for i, s in enumerate(self.slices):
+        self.current_slice = current_slice
+        self.explore = explore
+        self.scheduler.set_slice(current_slice)
+        for i in range(self.world.depth):
             d = abs(current_slice - i)
             if explore:
-                if s.chunks:
+                if i in self.content:
+                    s = self.slice(i)
+                    s.first_update()
                     s.show()
                     s.setShaderInput('color_scale', 1.0)
                     s.hide_hidden()
-                else:
-                    s.hide()
+                elif self.slices[i] is not None:
+                    self.slices[i].hide()
             else:
                 if i > current_slice or d > 5:
-                    s.hide()
+                    if self.slices[i] is not None:
+                        self.slices[i].hide()
+                    continue
+
+                s = self.slice(i)
+                s.first_update()
+                s.show()
+                if d:
+                    v = 0.9 - d / 8.0
+                    s.setShaderInput('color_scale', v)
                 else:
-                    s.first_update()
-                    s.show()
-                    if d:
-                        v = 0.9 - d / 8.0
-                        s.setShaderInput('color_scale', v)
-                    else:
-                        s.setShaderInput('color_scale', 1.0)
+                    s.setShaderInput('color_scale', 1.0)
 
                 if d == 0:
                     s.show_hidden()
                 else:
                     s.hide_hidden()
 
-    def block_update(self, pos):
-        x, y, z = pos
-        self.slices[z].update(x, y)
+        self.evict()
+
+    def blocks_updated(self, chunks):
+        self.visibility.invalidate()
+        for z, cx, cy in chunks:
+            self.content.add(z)
+            self.edited.add((cx, cy))
+            self.drop_cap(cx, cy)
+            if self.slices[z] is not None:
+                self.slices[z].update(cx, cy)
 
     def update_all(self):
-        for s in self.slices:
-            s.update_all()
+        self.scan_content()
+        self.visibility.invalidate()
+        self.set_capped(set())
+        for key in list(self.cap_nodes):
+            self.drop_cap(*key)
+        for s in self.materialized():
+            if s.first_update_done:
+                s.update_all()
 
     def reparent_entity(self, ent):
-        ent.node.reparentTo(self.slices[ent.z])
+        ent.node.reparentTo(self.slice(ent.z))
 
     def designation(self, x, y, z, n):
         n.setPos(x, y, 0)
-        n.reparentTo(self.slices[z])
+        n.reparentTo(self.slice(z))
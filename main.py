@@ -19,10 +19,12 @@ import gui
 import geometry
 import block_picker
 import zmap
+import minimap
 import console
 import dorf
 import tools
 import designation
+import autosave
 
 #loadPrcFileData("", "want-directtools #t")
 #loadPrcFileData("", "want-tk #t")
@@ -69,7 +71,7 @@ class Dorfdelf(ShowBase):
         self.graphicsEngine.renderFrame()
         self.graphicsEngine.renderFrame()
 
-        self.world_geometry = geometry.WorldGeometry(self.world)
+        self.world_geometry = geometry.WorldGeometry(self.world, self.cam)
 
         self.camLens.setFocalLength(1)
         self.camera.setPos(0, 0, 100)
@@ -94,6 +96,7 @@ class Dorfdelf(ShowBase):
         self.accept('console-command', self.console_command)
 
         self.designation = designation.Designation()
+        self.autosave = None
 
         self.dorfs = []
         self.tool = lambda w, x, y, z: None
@@ -107,6 +110,7 @@ class Dorfdelf(ShowBase):
         self.console = console.Console(self)
         self.picker = block_picker.BlockPicker(self.world, self)
         self.zmap = zmap.ZMap(self.world, self)
+        self.minimap = minimap.Minimap(self.world, self)
 
         self.change_slice(0)
 
@@ -119,26 +123,23 @@ class Dorfdelf(ShowBase):
         loading.hide()
 
     def add_light(self):
-        x, y = random.choice(list(self.world.columns()))
-        for z in reversed(range(self.world.depth)):
-            b = self.world.get_block(x, y, z)
-            if not b.is_void:
-                p = core.PointLight('pl-{}-{}-{}'.format(x, y, z))
-                p.setAttenuation(Point3(0, 0, 0.4))
-                pn = self.render.attachNewNode(p)
-                pn.setPos(x, y, z + 3)
-                self.render.setLight(pn)
+        x, y = random.randrange(self.world.width), random.randrange(self.world.height)
+        z = self.world.surface(x, y)
+        if z >= 0:
+            p = core.PointLight('pl-{}-{}-{}'.format(x, y, z))
+            p.setAttenuation(Point3(0, 0, 0.4))
+            pn = self.render.attachNewNode(p)
+            pn.setPos(x, y, z + 3)
+            self.render.setLight(pn)
 
     def add_dorf(self):
-        x, y = random.choice(list(self.world.columns()))
-        for z in reversed(range(self.world.depth)):
-            b = self.world.get_block(x, y, z)
-            if not b.is_void:
-                d = dorf.Dorf(Point3(x, y, z + 1), self.world)
-                self.dorfs.append(d)
-                if not b.is_block:
-                    self.world.set_block(x, y, z, self.world.forms['Block'], b.substance, False)
-                break
+        x, y = random.randrange(self.world.width), random.randrange(self.world.height)
+        z = self.world.surface(x, y)
+        if z >= 0:
+            d = dorf.Dorf(Point3(x, y, z + 1), self.world)
+            self.dorfs.append(d)
+            if not self.world.is_block(x, y, z):
+                self.world.set_block(x, y, z, self.world.form_ids['Block'], self.world.substance(x, y, z), False)
 
     def accept_keyboard(self):
         self.accept('e-repeat', self.change_slice, [-1])
@@ -190,10 +191,20 @@ class Dorfdelf(ShowBase):
         if cmd == 'generate':
             self.world.generate()
             self.world_geometry.update_all()
+            self.zmap.update_all()
+            self.minimap.update_all()
+            self.picker.invalidate()
         if cmd == 't':
             t = args.pop(0)
             self.tool = self.tools[t]
             self.toolargs = args
+        if cmd == 'autosave':
+            if self.autosave:
+                self.autosave.destroy()
+                self.autosave = None
+            if args and args[0] != 'off':
+                interval = float(args[1]) if len(args) > 1 else 5.0
+                self.autosave = autosave.Autosave(self.world, args[0], interval)
 
     def toggle_explore(self):
         self.explore_mode = not self.explore_mode
@@ -205,7 +216,7 @@ class Dorfdelf(ShowBase):
         self.messenger.send('slice-changed', [self.current_slice, self.explore_mode])
 
     def toggle_block(self):
-        if not self.picker.picked:
+        if not self.picker.picked or self.minimap.under_mouse():
             return
 
         x, y, z = self.picker.picked
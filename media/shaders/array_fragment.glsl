@@ -0,0 +1,35 @@
+#version 330
+
+
+in Data {
+    vec3 normal;
+    vec2 texcoord;
+    flat float layer;
+    flat float hidden;
+} DataIn;
+
+uniform sampler2DArray p3d_Texture0;
+uniform sampler2D border_texture;
+uniform mat4 light;
+uniform mat4 p3d_ModelViewMatrix;
+uniform float color_scale;
+uniform float show_hidden;
+
+out vec4 frag_color;
+
+#pragma include "lighting.glsl"
+
+void main() {
+    if (DataIn.hidden > 0.5 && show_hidden < 0.5) {
+        discard;
+    }
+
+    vec3 n = normalize(DataIn.normal);
+    // The hidden overlay is the one layer that must not repeat
+    vec2 uv = DataIn.hidden > 0.5 ? clamp(DataIn.texcoord, 0.0, 1.0) : DataIn.texcoord;
+    vec4 tex_color = texture(p3d_Texture0, vec3(uv, DataIn.layer));
+    vec4 border_color = texture(border_texture, DataIn.texcoord);
+    tex_color *= border_color;
+    vec3 result = degamma(tex_color.rgb) * sh_light(n, beach);
+    frag_color = vec4(gamma(result) * color_scale, tex_color.a);
+}
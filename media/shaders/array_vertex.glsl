@@ -0,0 +1,24 @@
+#version 330
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec2 p3d_MultiTexCoord0;
+in float layer;
+in float hidden;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+out Data {
+    vec3 normal;
+    vec2 texcoord;
+    flat float layer;
+    flat float hidden;
+} DataOut;
+
+void main()
+{
+    DataOut.normal = normalize(p3d_Normal);
+    DataOut.texcoord = p3d_MultiTexCoord0;
+    DataOut.layer = layer;
+    DataOut.hidden = hidden;
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+}
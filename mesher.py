@@ -0,0 +1,274 @@
+"""
+Culled and greedy meshing of slice tiles.
+
+Every form's triangles are grouped into faces by their normal. A face lying on a side
+of the cell is dropped when the neighbouring cell on the same slice is solid. Faces that
+are full quads (the tops of blocks and floors and the sides that span a whole cell) are
+shared between forms and merged with their neighbours into larger quads: top faces in
+both directions, side faces along the side. Texture coordinates keep running across a
+merged quad, so repeating textures, including the border, look the same as per cell.
+
+Caps stand in for whole stacks of slices far from the camera: the top of every column
+of a heightmap is meshed as a block, with sides down to the neighbouring columns.
+
+Meshes are (n, 8) float32 vertex arrays laid out like GeomVertexFormat.getV3n3t2(),
+positioned relative to the tile, and uint32 triangle index arrays.
+"""
+import numpy
+
+from world import DIRECTIONS
+
+
+SIDES = ('front', 'back', 'left', 'right')
+
+
+class Face(object):
+    """
+    A group of triangles of a form with the same normal, as (m, 8) vertices and local indices.
+    `side` is the direction of the cell side it lies on, if any, and `axes` the cell axes
+    a mergeable face can be stretched along.
+    """
+
+    def __init__(self, vertices, indices, side, axes):
+        self.vertices = vertices
+        self.indices = indices
+        self.side = side
+        self.axes = axes
+
+        if axes:
+            # Texture coordinates as an affine function of the position, to extend them over merged quads
+            positions = numpy.hstack([vertices[:, :3], numpy.ones((len(vertices), 1))])
+            self.uv_transform = numpy.linalg.lstsq(positions, vertices[:, 6:], rcond=None)[0]
+
+
+class FaceTable(object):
+    """
+    The faces of every form of a FormRegistry. Identical mergeable faces of different forms
+    share an entry, so that e.g. the sides of blocks and ramps merge with each other.
+    """
+
+    def __init__(self, registry):
+        self.solid = registry.solid
+        self.faces = []
+        keys = {}
+        has_face = []
+
+        for form in registry.forms:
+            row = set()
+            for face in self.split(form):
+                key = None
+                if face.axes:
+                    key = tuple(sorted(tuple(v) for v in numpy.round(face.vertices, 4)))
+                if key in keys:
+                    row.add(keys[key])
+                    continue
+
+                if key is not None:
+                    keys[key] = len(self.faces)
+                row.add(len(self.faces))
+                self.faces.append(face)
+            has_face.append(row)
+
+        self.has_face = numpy.zeros((len(registry.forms) + 1, len(self.faces)), numpy.bool_)
+        for form_id, row in enumerate(has_face):
+            self.has_face[form_id, list(row)] = True
+
+        self.block_sides = {}
+        for i in has_face[registry.ids['Block']]:
+            face = self.faces[i]
+            if face.side is not None:
+                self.block_sides[face.side] = face
+            elif face.axes:
+                self.block_top = face
+
+    @staticmethod
+    def split(form):
+        if not form.indices:
+            return []
+
+        vertices = numpy.array([tuple(v) + tuple(n) + tuple(t) for v, n, t in form.vertices], numpy.float32)
+        triangles = numpy.array(form.indices, numpy.uint32).reshape(-1, 3)
+
+        groups = {}
+        for triangle in triangles:
+            normal = tuple(numpy.round(vertices[triangle[0], 3:6], 2))
+            groups.setdefault(normal, []).append(triangle)
+
+        faces = []
+        for normal, group in groups.items():
+            used, local = numpy.unique(numpy.array(group), return_inverse=True)
+            face_vertices = vertices[used]
+            positions = face_vertices[:, :3]
+
+            side = None
+            for name in SIDES:
+                if normal == DIRECTIONS[name]:
+                    axis = 0 if DIRECTIONS[name][0] else 1
+                    if (positions[:, axis] == 0.5 * normal[axis]).all():
+                        side = name
+
+            axes = ()
+            if normal == DIRECTIONS['up']:
+                axes = (0, 1)
+            elif side is not None:
+                axes = (1,) if DIRECTIONS[side][0] else (0,)
+            full = len(used) == 4 and all(sorted(set(positions[:, a])) == [-0.5, 0.5] for a in axes)
+
+            faces.append(Face(face_vertices, local.ravel().astype(numpy.uint32), side, axes if full else ()))
+        return faces
+
+    def mesh(self, form, substance, hidden, merge=True):
+        """
+        Meshes the visible cells of a (y, x) tile. `form` holds the form ids of the tile padded by one cell
+        on every side. Returns a dict of substance: (vertices, indices).
+        """
+        inner = form[1:-1, 1:-1]
+        h, w = inner.shape
+        visible = (substance != 0) & ~hidden
+
+        culled = {}
+        for name in SIDES:
+            dx, dy, _ = DIRECTIONS[name]
+            culled[name] = self.solid[form[1 + dy:h + 1 + dy, 1 + dx:w + 1 + dx]]
+
+        meshes = {}
+        for s in numpy.unique(substance[visible]):
+            cells = visible & (substance == s)
+            present = numpy.flatnonzero(self.has_face[numpy.unique(inner[cells])].any(axis=0))
+
+            vertices, indices, count = [], [], 0
+            for i in present:
+                face = self.faces[i]
+                mask = cells & self.has_face[inner, i]
+                if face.side is not None:
+                    mask &= ~culled[face.side]
+                if not mask.any():
+                    continue
+
+                if face.axes:
+                    v = self.quads(face, rectangles(mask, face.axes, merge))
+                else:
+                    ys, xs = numpy.nonzero(mask)
+                    v = face.vertices[None].repeat(len(xs), axis=0)
+                    v[:, :, 0] += xs[:, None]
+                    v[:, :, 1] += ys[:, None]
+
+                n, m = v.shape[:2]
+                vertices.append(v.reshape(-1, 8))
+                indices.append((face.indices[None] + (count + m * numpy.arange(n, dtype=numpy.uint32))[:, None]).ravel())
+                count += n * m
+
+            if vertices:
+                meshes[int(s)] = (numpy.concatenate(vertices), numpy.concatenate(indices))
+        return meshes
+
+    def cap(self, heights, substance):
+        """
+        Meshes a (y, x) heightmap as columns of blocks, for terrain seen from afar. `heights` holds the level
+        of the top cell of every column, -1 for none, padded by one cell on every side, and `substance` the
+        substance of the top cells. Tops are merged, and sides reach down to the neighbouring column.
+        Positions are relative to the tile at level 0. Returns a dict of substance: (vertices, indices).
+        """
+        inner = heights[1:-1, 1:-1]
+        h, w = inner.shape
+        present = inner >= 0
+
+        meshes = {}
+        for s in numpy.unique(substance[present]):
+            cells = present & (substance == s)
+
+            parts = []
+            for z in numpy.unique(inner[cells]):
+                v = self.quads(self.block_top, rectangles(cells & (inner == z), self.block_top.axes))
+                v[:, :, 2] += z
+                parts.append((self.block_top, v))
+
+            for name in SIDES:
+                face = self.block_sides[name]
+                dx, dy, _ = DIRECTIONS[name]
+                neighbour = heights[1 + dy:h + 1 + dy, 1 + dx:w + 1 + dx]
+                mask = cells & (neighbour < inner)
+                if not mask.any():
+                    continue
+
+                ys, xs = numpy.nonzero(mask)
+                bottom = neighbour[mask, None] + 1
+                height = inner[mask, None] - bottom + 1
+
+                local = numpy.ones((len(xs), len(face.vertices), 4), numpy.float32)
+                local[:, :, :3] = face.vertices[None, :, :3]
+                local[:, :, 2] *= height
+                v = face.vertices[None].repeat(len(xs), axis=0)
+                v[:, :, 0] += xs[:, None]
+                v[:, :, 1] += ys[:, None]
+                v[:, :, 2] = local[:, :, 2] + bottom
+                v[:, :, 6:] = local.dot(face.uv_transform)
+                parts.append((face, v))
+
+            vertices, indices, count = [], [], 0
+            for face, v in parts:
+                n, m = v.shape[:2]
+                vertices.append(v.reshape(-1, 8))
+                indices.append((face.indices[None] + (count + m * numpy.arange(n, dtype=numpy.uint32))[:, None]).ravel())
+                count += n * m
+            meshes[int(s)] = (numpy.concatenate(vertices), numpy.concatenate(indices))
+        return meshes
+
+    @staticmethod
+    def quads(face, rects):
+        """
+        Stretches a full quad face over (x0, y0, x1, y1) cell rectangles, ends inclusive.
+        """
+        x0, y0, x1, y1 = (rects[:, i, None] for i in range(4))
+        template = face.vertices[None]
+
+        v = template.repeat(len(rects), axis=0)
+        v[:, :, 0] += numpy.where(template[:, :, 0] < 0, x0, x1)
+        v[:, :, 1] += numpy.where(template[:, :, 1] < 0, y0, y1)
+
+        local = numpy.ones(v.shape[:2] + (4,), numpy.float32)
+        local[:, :, :3] = v[:, :, :3]
+        local[:, :, 0] -= x0
+        local[:, :, 1] -= y0
+        v[:, :, 6:] = local.dot(face.uv_transform)
+        return v
+
+
+def rectangles(mask, axes, merge=True):
+    """
+    Covers a (y, x) mask with (x0, y0, x1, y1) rectangles, ends inclusive, growing them along `axes`.
+    """
+    if not merge or not axes:
+        ys, xs = numpy.nonzero(mask)
+        return numpy.stack([xs, ys, xs, ys], axis=1)
+
+    transposed = axes == (1,)
+    if transposed:
+        mask = mask.T
+
+    # Runs along the rows
+    h, w = mask.shape
+    padded = numpy.zeros((h, w + 2), numpy.int8)
+    padded[:, 1:-1] = mask
+    edges = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(edges == 1)
+    ends = numpy.nonzero(edges == -1)[1] - 1
+
+    if len(axes) == 2:
+        # Grow runs down into identical runs on the following rows
+        rects = []
+        open_runs = {}
+        for row, start, end in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+            rect = open_runs.get((start, end))
+            if rect is not None and rect[3] == row - 1:
+                rect[3] = row
+            else:
+                rect = open_runs[(start, end)] = [start, row, end, row]
+                rects.append(rect)
+        rects = numpy.array(rects).reshape(-1, 4)
+    else:
+        rects = numpy.stack([starts, rows, ends, rows], axis=1)
+
+    if transposed:
+        rects = rects[:, [1, 0, 3, 2]]
+    return rects
@@ -0,0 +1,152 @@
+from direct.showbase.DirectObject import DirectObject
+
+import numpy
+from panda3d.core import Point2, Point3, Vec3, Texture, CardMaker
+
+from storage import CHUNK_SIZE, CHUNK_DEPTH
+from zmap import ZMap
+
+
+class Minimap(DirectObject):
+    """
+    A top-down map of the world: the surface in explore mode, the current slice otherwise.
+
+    Changed chunk tiles are repainted once per frame, only their texels. Clicking on the map
+    moves the camera so that it looks at the clicked spot.
+    """
+    SIZE = 0.35
+
+    def __init__(self, world, app):
+        self.world = world
+        self.app = app
+
+        self.slice = None
+        self.explore = None
+        self.dirty = set()
+
+        self.texture = Texture('minimap')
+        self.texture.setup2dTexture(self.world.width, self.world.height, Texture.TUnsignedByte, Texture.FRgb)
+        self.texture.setMagfilter(Texture.FTNearest)
+        self.texture.setMinfilter(Texture.FTLinear)
+
+        # Square cells on screen, whatever the shape of the window
+        width = Minimap.SIZE
+        height = width * app.getAspectRatio() * self.world.height / float(self.world.width)
+        self.frame = (0.93 - width, 0.93, -0.98, -0.98 + height)
+
+        cm = CardMaker('minimap')
+        cm.setFrame(*self.frame)
+        self.card = app.render2d.attachNewNode(cm.generate())
+        self.card.setTexture(self.texture)
+
+        cm = CardMaker('minimap-pointer')
+        cm.setFrame(-0.005, 0.005, -0.005 * app.getAspectRatio(), 0.005 * app.getAspectRatio())
+        self.pointer = app.render2d.attachNewNode(cm.generate())
+        self.pointer.setColorScale(1.0, 0.0, 0.0, 1.0)
+
+        self.accept('slice-changed', self.slice_changed)
+        self.accept('blocks-updated', self.blocks_updated)
+        self.accept('mouse1', self.click)
+        self.addTask(self.update, 'Minimap update')
+
+    def colors(self, x0, x1, y0, y1):
+        """
+        The (y, x, rgb) colours of the cells in [x0, x1) x [y0, y1).
+        """
+        if self.explore:
+            heights = self.world.heightmap(False, x0, x1, y0, y1)
+            substance = numpy.zeros(heights.shape, numpy.uint8)
+            for z0 in range(0, self.world.depth, CHUNK_DEPTH):
+                band = (heights >= z0) & (heights < z0 + CHUNK_DEPTH)
+                if band.any():
+                    region = self.world.region(x0, x1, y0, y1, z0, z0 + CHUNK_DEPTH)
+                    top = numpy.clip(heights - z0, 0, region.shape[0] - 1)[None]
+                    substance[band] = numpy.take_along_axis(region.substance, top, axis=0)[0][band]
+            # Higher ground is lighter
+            shade = 0.4 + 0.6 * numpy.maximum(heights, 0) / float(self.world.depth)
+        else:
+            region = self.world.region(x0, x1, y0, y1, self.slice, self.slice + 1)
+            substance = region.substance[0]
+            shade = numpy.where(self.world.registry.solid[region.form[0]], 1.0, 0.75)
+            shade = numpy.where(region.hidden[0], 0.4, shade)
+
+        colors = ZMap.COLORS[substance] * shade[..., None]
+        return numpy.where((substance == 0)[..., None], 0.15, colors)
+
+    def paint(self, x0, x1, y0, y1):
+        image = numpy.frombuffer(memoryview(self.texture.modifyRamImage()), numpy.uint8)
+        image = image.reshape(self.world.height, self.world.width, 3)
+        # RAM images are stored as BGR, bottom row first
+        image[y0:y1, x0:x1] = numpy.round(self.colors(x0, x1, y0, y1)[..., ::-1] * 255)
+
+    def update_all(self):
+        self.dirty = set()
+        self.paint(0, self.world.width, 0, self.world.height)
+
+    def slice_changed(self, slice, explore):
+        if explore != self.explore or (not explore and slice != self.slice):
+            self.slice = slice
+            self.explore = explore
+            self.update_all()
+        self.slice = slice
+
+    def blocks_updated(self, chunks):
+        for z, cx, cy in chunks:
+            if self.explore or z == self.slice:
+                self.dirty.add((cx, cy))
+
+    def update(self, task):
+        for cx, cy in self.dirty:
+            self.paint(cx * CHUNK_SIZE, min((cx + 1) * CHUNK_SIZE, self.world.width),
+                       cy * CHUNK_SIZE, min((cy + 1) * CHUNK_SIZE, self.world.height))
+        self.dirty = set()
+
+        pos = self.app.cc.body.getPos(self.app.render)
+        self.pointer.setPos(self.to_screen(pos.x, pos.y))
+        return task.cont
+
+    def to_screen(self, x, y):
+        left, right, bottom, top = self.frame
+        u = min(max((x + 0.5) / self.world.width, 0.0), 1.0)
+        v = min(max((y + 0.5) / self.world.height, 0.0), 1.0)
+        return Point3(left + u * (right - left), 0, bottom + v * (top - bottom))
+
+    def to_world(self, mouse):
+        """
+        The world (x, y) under a render2d point, or None when it is off the map.
+        """
+        left, right, bottom, top = self.frame
+        if not (left <= mouse.x <= right and bottom <= mouse.y <= top):
+            return None
+        u = (mouse.x - left) / (right - left)
+        v = (mouse.y - bottom) / (top - bottom)
+        return u * self.world.width - 0.5, v * self.world.height - 0.5
+
+    def under_mouse(self):
+        mouse = self.app.mouseWatcherNode
+        return mouse.hasMouse() and self.to_world(Point2(mouse.getMouse())) is not None
+
+    def click(self):
+        mouse = self.app.mouseWatcherNode
+        if not mouse.hasMouse():
+            return
+        target = self.to_world(Point2(mouse.getMouse()))
+        if target is not None:
+            self.look_at(*target)
+
+    def look_at(self, x, y):
+        """
+        Moves the camera body so that the spot it looks at lands on (x, y).
+        """
+        body = self.app.cc.body
+        eye = self.app.cam
+        origin = eye.getPos(self.app.render)
+        direction = self.app.render.getRelativeVector(eye, (0, 1, 0))
+
+        hit = self.world.raycast(origin, direction)
+        if hit is None:
+            focus = body.getPos(self.app.render)
+        else:
+            (fx, fy, _), _ = hit
+            focus = Point3(fx, fy, 0)
+        body.setPos(self.app.render, body.getPos(self.app.render) + Vec3(x - focus.x, y - focus.y, 0))
@@ -0,0 +1,303 @@
+"""
+Binary world files.
+
+A .dorf file starts with a header:
+
+    magic 'DORF', uint16 version, uint32 width, height, depth
+    form table:      uint16 count, then per form a uint8 length and the utf-8 name
+    substance table: the same layout
+
+padded with zeros to a multiple of ALIGNMENT, followed by three planar uint8
+arrays of width * height * depth cells each, indexed by (z, y, x):
+form ids, substances and hidden flags.
+
+A .dorfz file has the same header with the magic 'DORZ', then the uint16 chunk
+size and depth and a uint64 checkpoint id (since version 2), then an index
+with one entry per chunk in (cx, cy, cz) order:
+
+    uint64 offset, uint32 length, uint8 form, substance, hidden
+
+A chunk with zero length is uniform and the index entry holds its value.
+Otherwise `length` bytes at `offset` are the zlib-compressed planar arrays
+of the chunk, so any chunk can be read without touching the others.
+
+A .dorfz.journal file next to it starts with the header (magic 'DORJ') and
+the uint64 id of the checkpoint it belongs to; a journal whose id does not
+match is stale and ignored. It is followed by chunks changed since that
+checkpoint, appended as records:
+
+    uint16 cx, cy, cz, uint32 length, uint8 form, substance, hidden
+
+with the same meaning as the index, and `length` bytes of chunk data.
+Later records for a chunk replace earlier ones.
+"""
+import itertools
+import os
+import struct
+import zlib
+
+import numpy
+
+
+EXTENSION = '.dorf'
+MAGIC = b'DORF'
+VERSION = 1
+ALIGNMENT = 16
+
+CHUNKED_EXTENSION = '.dorfz'
+CHUNKED_MAGIC = b'DORZ'
+CHUNKED_VERSION = 2
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = b'DORJ'
+JOURNAL_VERSION = 1
+
+HEADER = struct.Struct('<4sHIII')
+GRID = struct.Struct('<HH')
+CHECKPOINT = struct.Struct('<Q')
+INDEX_ENTRY = struct.Struct('<QIBBB')
+RECORD = struct.Struct('<HHHIBBB')
+
+
+def with_extension(fn, ext):
+    """
+    Appends `ext` to a file name that has no extension, since the console cannot type a dot.
+    """
+    return fn if os.path.splitext(fn)[1] else fn + ext
+
+
+def pack_names(names):
+    data = [struct.pack('<H', len(names))]
+    for name in names:
+        encoded = name.encode('utf-8')
+        data.append(struct.pack('<B', len(encoded)))
+        data.append(encoded)
+    return b''.join(data)
+
+
+def unpack_names(f):
+    count, = struct.unpack('<H', f.read(2))
+    names = []
+    for _ in range(count):
+        length, = struct.unpack('<B', f.read(1))
+        names.append(f.read(length).decode('utf-8'))
+    return names
+
+
+def write_header(f, extents, forms, substances, magic=MAGIC, version=VERSION):
+    header = HEADER.pack(magic, version, *extents) + pack_names(forms) + pack_names(substances)
+    header += b'\0' * (-len(header) % ALIGNMENT)
+    f.write(header)
+    return len(header)
+
+
+def read_header(f, expected=MAGIC):
+    magic, version, width, height, depth = HEADER.unpack(f.read(HEADER.size))
+    if magic != expected:
+        raise ValueError('Not a world file')
+
+    forms = unpack_names(f)
+    substances = unpack_names(f)
+    f.seek(-f.tell() % ALIGNMENT, 1)
+    return version, (width, height, depth), forms, substances
+
+
+def create(fn, extents, forms, substances):
+    """
+    Creates a world file and returns a writable (3, depth, height, width) memory map of its arrays.
+    """
+    width, height, depth = extents
+    with open(fn, 'wb') as f:
+        offset = write_header(f, extents, forms, substances)
+        f.truncate(offset + 3 * width * height * depth)
+
+    return numpy.memmap(fn, numpy.uint8, 'r+', offset, (3, depth, height, width))
+
+
+def load(fn):
+    """
+    Reads a world file. The arrays are copy-on-write memory maps of the file,
+    so nothing is read until a chunk is touched and edits never reach the disk.
+    Returns (extents, forms, substances, (form, substance, hidden)).
+    """
+    with open(fn, 'rb') as f:
+        version, extents, forms, substances = read_header(f)
+        offset = f.tell()
+
+    if version != VERSION:
+        raise ValueError('Unsupported world file version {}'.format(version))
+
+    width, height, depth = extents
+    data = numpy.memmap(fn, numpy.uint8, 'c', offset, (3, depth, height, width))
+    return extents, forms, substances, (data[0], data[1], data[2].view(numpy.bool_))
+
+
+def pack_chunk(form, substance, hidden):
+    data = b''.join(numpy.ascontiguousarray(a, numpy.uint8).tobytes() for a in (form, substance, hidden))
+    return zlib.compress(data)
+
+
+def unpack_chunk(data, shape):
+    arrays = numpy.frombuffer(zlib.decompress(data), numpy.uint8).reshape((3,) + tuple(shape)).copy()
+    return arrays[0], arrays[1], arrays[2].view(numpy.bool_)
+
+
+def new_checkpoint():
+    return CHECKPOINT.unpack(os.urandom(CHECKPOINT.size))[0]
+
+
+def save_chunked(fn, extents, forms, substances, store, chunk_size, chunk_depth, checkpoint=None):
+    """
+    Writes every chunk of a ChunkedStore compressed on its own, behind an offset index.
+    """
+    if checkpoint is None:
+        checkpoint = new_checkpoint()
+
+    keys = list(store.chunk_keys())
+    with open(fn, 'wb') as f:
+        write_header(f, extents, forms, substances, CHUNKED_MAGIC, CHUNKED_VERSION)
+        f.write(GRID.pack(chunk_size, chunk_depth))
+        f.write(CHECKPOINT.pack(checkpoint))
+        index_offset = f.tell()
+        f.write(b'\0' * INDEX_ENTRY.size * len(keys))
+
+        index = []
+        for key in keys:
+            c = store.chunk(key, create=True)
+            if c.uniform:
+                f_, s_, h_ = c.value
+                index.append(INDEX_ENTRY.pack(0, 0, f_, s_, h_))
+            else:
+                data = pack_chunk(c.form, c.substance, c.hidden)
+                index.append(INDEX_ENTRY.pack(f.tell(), len(data), 0, 0, 0))
+                f.write(data)
+
+        f.seek(index_offset)
+        f.write(b''.join(index))
+
+
+def start_journal(fn, extents, forms, substances, checkpoint):
+    with open(fn, 'wb') as f:
+        write_header(f, extents, forms, substances, JOURNAL_MAGIC, JOURNAL_VERSION)
+        f.write(CHECKPOINT.pack(checkpoint))
+
+
+def append_journal(fn, chunks):
+    """
+    Appends a record for every chunk. Returns the number of bytes written.
+    """
+    records = []
+    for c in chunks:
+        if c.uniform:
+            f_, s_, h_ = c.value
+            records.append(RECORD.pack(c.key[0], c.key[1], c.key[2], 0, f_, s_, h_))
+        else:
+            data = pack_chunk(c.form, c.substance, c.hidden)
+            records.append(RECORD.pack(c.key[0], c.key[1], c.key[2], len(data), 0, 0, 0))
+            records.append(data)
+
+    data = b''.join(records)
+    with open(fn, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+
+def read_journal(fn):
+    """
+    Returns (checkpoint, forms, substances, records) with (key, value, data) records, where `data`
+    is None for a uniform chunk and packed chunk data otherwise. A torn final record is dropped.
+    """
+    with open(fn, 'rb') as f:
+        version, extents, forms, substances = read_header(f, JOURNAL_MAGIC)
+        if version != JOURNAL_VERSION:
+            raise ValueError('Unsupported journal version {}'.format(version))
+        checkpoint, = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+
+        records = []
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            cx, cy, cz, length, f_, s_, h_ = RECORD.unpack(head)
+            data = f.read(length) if length else None
+            if length and len(data) < length:
+                break
+            records.append(((cx, cy, cz), (f_, s_, bool(h_)), data))
+
+    return checkpoint, forms, substances, records
+
+
+class ChunkFile(object):
+    """
+    Random access to the chunks of a .dorfz file. Only the header and the index are read up front.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.file = open(fn, 'rb')
+        version, self.extents, self.forms, self.substances = read_header(self.file, CHUNKED_MAGIC)
+        if version not in (1, CHUNKED_VERSION):
+            raise ValueError('Unsupported chunked world file version {}'.format(version))
+
+        self.chunk_size, self.chunk_depth = GRID.unpack(self.file.read(GRID.size))
+        self.checkpoint = 0
+        if version >= 2:
+            self.checkpoint, = CHECKPOINT.unpack(self.file.read(CHECKPOINT.size))
+
+        width, height, depth = self.extents
+        grid = (-(-width // self.chunk_size), -(-height // self.chunk_size), -(-depth // self.chunk_depth))
+        keys = list(itertools.product(*(range(n) for n in grid)))
+
+        data = self.file.read(INDEX_ENTRY.size * len(keys))
+        self.index = {key: INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i, key in enumerate(keys)}
+
+        self.form_lookup = None
+        self.substance_lookup = None
+
+    def close(self):
+        self.file.close()
+
+    def remap(self, form_lookup, substance_lookup):
+        self.form_lookup = form_lookup
+        self.substance_lookup = substance_lookup
+
+    def uniform_value(self, key):
+        """
+        The value of a uniform chunk, straight from the index, or None for a stored chunk.
+        """
+        offset, length, f, s, h = self.index[key]
+        if length:
+            return None
+        if self.form_lookup is not None:
+            f, s = int(self.form_lookup[f]), int(self.substance_lookup[s])
+        return f, s, bool(h)
+
+    def read_chunk(self, key, shape):
+        """
+        Returns (value, None) for a uniform chunk, or (None, (form, substance, hidden)) with (z, y, x) arrays.
+        """
+        value = self.uniform_value(key)
+        if value is not None:
+            return value, None
+
+        offset, length = self.index[key][:2]
+        self.file.seek(offset)
+        form, substance, hidden = unpack_chunk(self.file.read(length), shape)
+        if self.form_lookup is not None:
+            form, substance = self.form_lookup[form], self.substance_lookup[substance]
+        return None, (form, substance, hidden)
+
+    def stats(self):
+        width, height, depth = self.extents
+        stored = [length for offset, length, f, s, h in self.index.values() if length]
+        size = os.path.getsize(self.fn)
+        return {
+            'chunks': len(self.index),
+            'stored': len(stored),
+            'uniform': len(self.index) - len(stored),
+            'raw_bytes': width * height * depth * 3,
+            'file_bytes': size,
+            'ratio': width * height * depth * 3.0 / size,
+        }
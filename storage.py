@@ -0,0 +1,350 @@
+import itertools
+
+import numpy
+
+
+CHUNK_SIZE = 32
+CHUNK_DEPTH = 16
+
+EMPTY = (0, 0, False)
+
+
+class Chunk(object):
+    """
+    A CHUNK_SIZE x CHUNK_SIZE x CHUNK_DEPTH piece of the world.
+
+    A uniform chunk keeps a single (form, substance, hidden) value and no arrays;
+    the first write that breaks the uniformity splits it into planar (z, y, x) arrays.
+    Chunks on the far edges of the world are clipped to its extents.
+    """
+    __slots__ = ('key', 'origin', 'shape', 'value', 'form', 'substance', 'hidden')
+
+    def __init__(self, key, origin, shape, value=EMPTY):
+        self.key = key
+        self.origin = origin
+        self.shape = shape
+        self.value = value
+        self.form = None
+        self.substance = None
+        self.hidden = None
+
+    @property
+    def uniform(self):
+        return self.form is None
+
+    @property
+    def nbytes(self):
+        if self.form is None:
+            return 0
+        return self.form.nbytes + self.substance.nbytes + self.hidden.nbytes
+
+    def get(self, x, y, z):
+        if self.form is None:
+            return self.value
+        return self.form.item(z, y, x), self.substance.item(z, y, x), self.hidden.item(z, y, x)
+
+    def set(self, x, y, z, form, substance, hidden):
+        new = (form, substance, hidden)
+        if self.get(x, y, z) == new:
+            return False
+
+        if self.form is None:
+            self.split()
+
+        self.form[z, y, x] = form
+        self.substance[z, y, x] = substance
+        self.hidden[z, y, x] = hidden
+        return True
+
+    def split(self):
+        f, s, h = self.value
+        self.form = numpy.full(self.shape, f, numpy.uint8)
+        self.substance = numpy.full(self.shape, s, numpy.uint8)
+        self.hidden = numpy.full(self.shape, h, numpy.bool_)
+
+    def compact(self):
+        if self.form is None:
+            return True
+
+        f, s, h = self.form.flat[0], self.substance.flat[0], self.hidden.flat[0]
+        if (self.form == f).all() and (self.substance == s).all() and (self.hidden == h).all():
+            self.value = (int(f), int(s), bool(h))
+            self.form = self.substance = self.hidden = None
+            return True
+        return False
+
+    def read(self, box):
+        if self.form is None:
+            shape = tuple(s.stop - s.start for s in box)
+            f, s, h = self.value
+            return (numpy.full(shape, f, numpy.uint8),
+                    numpy.full(shape, s, numpy.uint8),
+                    numpy.full(shape, h, numpy.bool_))
+        return self.form[box], self.substance[box], self.hidden[box]
+
+    def write(self, box, form, substance, hidden, mask=None):
+        """
+        Writes arrays into the local (z, y, x) slices `box`, only where `mask` is set.
+        Returns a boolean array of the cells that actually changed.
+        """
+        old_form, old_substance, old_hidden = self.read(box)
+        changed = (old_form != form) | (old_substance != substance) | (old_hidden != hidden)
+        if mask is not None:
+            changed &= mask
+
+        if not changed.any():
+            return changed
+
+        if self.form is None:
+            self.split()
+
+        if changed.all():
+            self.form[box] = form
+            self.substance[box] = substance
+            self.hidden[box] = hidden
+        else:
+            self.form[box][changed] = numpy.broadcast_to(form, changed.shape)[changed]
+            self.substance[box][changed] = numpy.broadcast_to(substance, changed.shape)[changed]
+            self.hidden[box][changed] = numpy.broadcast_to(hidden, changed.shape)[changed]
+
+        if all(s.stop - s.start == n for s, n in zip(box, self.shape)):
+            self.compact()
+
+        return changed
+
+
+class ChunkedStore(object):
+    """
+    Sparse voxel storage split into lazily allocated chunks.
+
+    Chunks that were never written are not allocated at all and read as empty air.
+    With a source attached, chunks are instead read from it the first time they are touched.
+    Arrays passed to and returned from `read`/`write` are indexed by (z, y, x).
+    """
+
+    def __init__(self, width, height, depth):
+        self.width = width
+        self.height = height
+        self.depth = depth
+
+        self.chunks = {}
+        self.source = None
+        self.pending = set()
+        self.dirty = set()
+
+    @property
+    def grid_shape(self):
+        return (-(-self.width // CHUNK_SIZE),
+                -(-self.height // CHUNK_SIZE),
+                -(-self.depth // CHUNK_DEPTH))
+
+    def chunk_keys(self):
+        cw, ch, cd = self.grid_shape
+        return itertools.product(range(cw), range(ch), range(cd))
+
+    def chunk(self, key, create=False):
+        c = self.chunks.get(key)
+        if c is None and (create or key in self.pending):
+            cx, cy, cz = key
+            origin = (cx * CHUNK_SIZE, cy * CHUNK_SIZE, cz * CHUNK_DEPTH)
+            shape = (min(CHUNK_DEPTH, self.depth - origin[2]),
+                     min(CHUNK_SIZE, self.height - origin[1]),
+                     min(CHUNK_SIZE, self.width - origin[0]))
+            c = self.chunks[key] = Chunk(key, origin, shape)
+
+            if key in self.pending:
+                value, arrays = self.source.read_chunk(key, shape)
+                if arrays is None:
+                    c.value = value
+                else:
+                    c.form, c.substance, c.hidden = arrays
+                self.settle(key)
+        return c
+
+    def settle(self, key):
+        """
+        Takes a chunk off the pending set; the source is closed once nothing is left to read from it.
+        """
+        self.pending.discard(key)
+        if not self.pending:
+            self.close_source()
+
+    def close_source(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def uniform_value(self, key):
+        """
+        The value of a uniform chunk, or None for a chunk with arrays. Chunks that are not
+        loaded yet are not read: their source tells from its index.
+        """
+        if key in self.pending:
+            return self.source.uniform_value(key)
+        c = self.chunks.get(key)
+        if c is None:
+            return EMPTY
+        return c.value if c.uniform else None
+
+    def is_pending(self, key):
+        """
+        Whether a chunk is still waiting to be read from the source.
+        """
+        return key in self.pending
+
+    def get(self, x, y, z):
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_DEPTH)
+        c = self.chunks.get(key) or self.chunk(key)
+        if c is None:
+            return EMPTY
+        ox, oy, oz = c.origin
+        return c.get(x - ox, y - oy, z - oz)
+
+    def set(self, x, y, z, form, substance, hidden):
+        c = self.chunk((x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_DEPTH), create=True)
+        ox, oy, oz = c.origin
+        if c.set(x - ox, y - oy, z - oz, form, substance, hidden):
+            self.dirty.add(c.key)
+            return True
+        return False
+
+    def overlapping(self, x0, x1, y0, y1, z0, z1):
+        """
+        Yields (key, local box, box relative to (x0, y0, z0)) for every chunk touching the box.
+        """
+        for cx in range(x0 // CHUNK_SIZE, -(-x1 // CHUNK_SIZE)):
+            for cy in range(y0 // CHUNK_SIZE, -(-y1 // CHUNK_SIZE)):
+                for cz in range(z0 // CHUNK_DEPTH, -(-z1 // CHUNK_DEPTH)):
+                    ox, oy, oz = cx * CHUNK_SIZE, cy * CHUNK_SIZE, cz * CHUNK_DEPTH
+                    ax0, ax1 = max(x0, ox), min(x1, ox + CHUNK_SIZE)
+                    ay0, ay1 = max(y0, oy), min(y1, oy + CHUNK_SIZE)
+                    az0, az1 = max(z0, oz), min(z1, oz + CHUNK_DEPTH)
+                    local = (slice(az0 - oz, az1 - oz), slice(ay0 - oy, ay1 - oy), slice(ax0 - ox, ax1 - ox))
+                    rel = (slice(az0 - z0, az1 - z0), slice(ay0 - y0, ay1 - y0), slice(ax0 - x0, ax1 - x0))
+                    yield (cx, cy, cz), local, rel
+
+    def read(self, x0, x1, y0, y1, z0, z1):
+        shape = (z1 - z0, y1 - y0, x1 - x0)
+        form = numpy.zeros(shape, numpy.uint8)
+        substance = numpy.zeros(shape, numpy.uint8)
+        hidden = numpy.zeros(shape, numpy.bool_)
+
+        for key, local, rel in self.overlapping(x0, x1, y0, y1, z0, z1):
+            c = self.chunk(key)
+            if c is None:
+                continue
+            if c.form is None:
+                form[rel], substance[rel], hidden[rel] = c.value
+            else:
+                form[rel] = c.form[local]
+                substance[rel] = c.substance[local]
+                hidden[rel] = c.hidden[local]
+
+        return form, substance, hidden
+
+    def write(self, x0, y0, z0, form, substance, hidden, mask=None):
+        """
+        Writes (z, y, x) arrays with the corner at (x0, y0, z0).
+        Scalars are broadcast over the shape of the arrays, so at least one of form, substance,
+        hidden or `mask` must be a (z, y, x) array. Returns the mask of changed cells.
+        """
+        shape = numpy.broadcast(form, substance, hidden, True if mask is None else mask).shape
+        if len(shape) != 3:
+            raise ValueError('Writing needs a (z, y, x) array or mask, got shape {}'.format(shape))
+        form, substance, hidden = (numpy.broadcast_to(a, shape) for a in (form, substance, hidden))
+        if mask is not None:
+            mask = numpy.broadcast_to(mask, shape)
+        z1, y1, x1 = z0 + shape[0], y0 + shape[1], x0 + shape[2]
+
+        changed = numpy.zeros(shape, numpy.bool_)
+        for key, local, rel in self.overlapping(x0, x1, y0, y1, z0, z1):
+            c = self.chunk(key, create=True)
+            changed[rel] = c.write(local, form[rel], substance[rel], hidden[rel],
+                                   None if mask is None else mask[rel])
+            if changed[rel].any():
+                self.dirty.add(key)
+        return changed
+
+    def attach(self, form, substance, hidden):
+        """
+        Replaces the contents with views into full-size (z, y, x) arrays, such as memory maps,
+        so that nothing is copied until a chunk is written to.
+        """
+        self.close_source()
+        self.chunks = {}
+        self.pending = set()
+        self.dirty = set()
+        for key in self.chunk_keys():
+            c = self.chunk(key, create=True)
+            x0, y0, z0 = c.origin
+            box = (slice(z0, z0 + c.shape[0]), slice(y0, y0 + c.shape[1]), slice(x0, x0 + c.shape[2]))
+            c.form, c.substance, c.hidden = form[box], substance[box], hidden[box]
+
+    def attach_source(self, source):
+        """
+        Replaces the contents with chunks read lazily through `source.read_chunk(key, shape)`.
+        `source.uniform_value(key)` tells uniform chunks apart without reading them.
+        """
+        self.close_source()
+        self.chunks = {}
+        self.source = source
+        self.pending = set(self.chunk_keys())
+        self.dirty = set()
+        if not self.pending:
+            self.close_source()
+
+    def replace(self, key, value=EMPTY, arrays=None):
+        """
+        Replaces a whole chunk with a value or a tuple of (z, y, x) arrays without marking it dirty.
+        """
+        self.settle(key)
+        c = self.chunk(key, create=True)
+        c.value = value
+        c.form, c.substance, c.hidden = (None, None, None) if arrays is None else arrays
+        return c
+
+    def take_dirty(self):
+        """
+        Returns the keys of the chunks changed since the last call.
+        """
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def snapshot(self, keys=None):
+        """
+        A store holding copies of the given chunks (every chunk by default) that later writes won't affect.
+        """
+        copy = ChunkedStore(self.width, self.height, self.depth)
+        for key in (self.chunk_keys() if keys is None else keys):
+            c = self.chunk(key)
+            if c is None:
+                continue
+
+            s = copy.chunk(key, create=True)
+            s.value = c.value
+            if not c.uniform:
+                s.form, s.substance, s.hidden = numpy.array(c.form), numpy.array(c.substance), numpy.array(c.hidden)
+        return copy
+
+    def compact(self):
+        for c in self.chunks.values():
+            c.compact()
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.chunks.values())
+
+    def stats(self):
+        cw, ch, cd = self.grid_shape
+        total = cw * ch * cd
+        dense = sum(1 for c in self.chunks.values() if not c.uniform)
+        uniform = len(self.chunks) - dense
+        return {
+            'chunks': total,
+            'dense': dense,
+            'uniform': uniform,
+            'unloaded': len(self.pending),
+            'unallocated': total - dense - uniform - len(self.pending),
+            'bytes': self.nbytes,
+            'dense_bytes': self.width * self.height * self.depth * 3,
+        }
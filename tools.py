@@ -1,20 +1,34 @@
-import itertools
 import random
 
+import numpy
+
 
 def bomb(world, x, y, z, r=5):
     r = int(r)
     rr = r * r
-    for ix, iy, iz in itertools.product(range(x - r, x + r + 1), range(y - r, y + r + 1), range(z - r, z + r + 1)):
-        dsq = (x - ix) * (x - ix) + (y - iy) * (y - iy) + (z - iz) * (z - iz)
-        if random.randint(rr - r, rr) > dsq:
-            world.set_block(ix, iy, iz, world.forms['Void'], 0, False)
-    for ix, iy, iz in itertools.product(range(x - r, x + r + 1), range(y - r, y + r + 1), range(z - r, z)):
-        b = world.get_block(ix, iy, iz)
-        if b.is_void and b.down.is_block:
-            world.make_ramp(ix, iy, iz)
+    n = 2 * r + 1
+
+    # One draw per cell of the cube in (x, y, z) order, whether or not it lies within the world
+    threshold = numpy.array([random.randint(rr - r, rr) for _ in range(n * n * n)]).reshape(n, n, n).T
+    d = numpy.arange(-r, r + 1)
+    dsq = d[:, None, None] ** 2 + d[None, :, None] ** 2 + d[None, None, :] ** 2
+    blast = threshold > dsq
+
+    with world.batch():
+        cube = world.region(x - r, x + r + 1, y - r, y + r + 1, z - r, z + r + 1)
+        if all(cube.shape):
+            mask = blast[cube.z0 - z + r:cube.z1 - z + r,
+                         cube.y0 - y + r:cube.y1 - y + r,
+                         cube.x0 - x + r:cube.x1 - x + r]
+            world.write(cube.x0, cube.y0, cube.z0, world.form_ids['Void'], 0, False, mask)
+
+        below = world.region(x - r, x + r + 1, y - r, y + r + 1, z - r - 1, z)
+        if below.shape[0] > 1:
+            ramps = world.registry.void[below.form[1:]] & world.registry.solid[below.form[:-1]]
+            for iz, iy, ix in zip(*numpy.nonzero(ramps)):
+                world.make_ramp(below.x0 + int(ix), below.y0 + int(iy), below.z0 + 1 + int(iz))
 
 
 def block(world, x, y, z, form='Block', substance=1):
     substance = int(substance)
-    world.set_block(x, y, z, world.forms[form], substance, False)
+    world.set_block(x, y, z, world.form_ids[form], substance, False)
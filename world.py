@@ -1,10 +1,21 @@
 import itertools
 import json
+import math
+import os
 
+import numpy
 import panda3d.core as core
 from direct.showbase.MessengerGlobal import messenger
 from direct.directnotify.DirectNotifyGlobal import directNotify
 
+import cache
+import savefile
+from storage import ChunkedStore, CHUNK_SIZE, CHUNK_DEPTH
+
+
+FORMS_EGG = 'media/models/forms.egg'
+
+_registry = None
 
 DIRECTIONS = {
     'up': (0, 0, 1),
@@ -17,7 +28,52 @@ DIRECTIONS = {
 
 
 def load_forms():
-    models = loader.loadModel('media/models/forms.egg')
+    """
+    The forms of forms.egg, from the compiled cache when it is up to date with the egg.
+    """
+    key = cache.digest([FORMS_EGG])
+    compiled = cache.load('forms', key)
+    if compiled is not None:
+        return decompile_forms(compiled)
+
+    forms = list(parse_forms())
+    cache.save('forms', key, **compile_forms(forms))
+    return forms
+
+
+def compile_forms(forms):
+    return {
+        'names': numpy.array([f.name for f in forms]),
+        'vertex_counts': numpy.array([f.num_vertices for f in forms], numpy.uint32),
+        'index_counts': numpy.array([len(f.indices) for f in forms], numpy.uint32),
+        'vertices': numpy.array([tuple(v) + tuple(n) + tuple(t) for f in forms for v, n, t in f.vertices],
+                                numpy.float32).reshape(-1, 8),
+        'indices': numpy.array([i for f in forms for i in f.indices], numpy.uint32),
+    }
+
+
+def decompile_forms(compiled):
+    vertices = numpy.split(compiled['vertices'], numpy.cumsum(compiled['vertex_counts'])[:-1])
+    indices = numpy.split(compiled['indices'], numpy.cumsum(compiled['index_counts'])[:-1])
+
+    forms = []
+    for name, v, i in zip(compiled['names'], vertices, indices):
+        forms.append(Form(str(name), [(tuple(r[:3]), tuple(r[3:6]), tuple(r[6:])) for r in v.tolist()], i.tolist()))
+    return forms
+
+
+def form_registry():
+    """
+    The FormRegistry shared by every World in the process.
+    """
+    global _registry
+    if _registry is None:
+        _registry = FormRegistry(load_forms())
+    return _registry
+
+
+def parse_forms():
+    models = loader.loadModel(FORMS_EGG)
 
     yield Form('Void', [], [])
 
@@ -51,19 +107,78 @@ def load_forms():
         yield Form(name, vertices, indices)
 
 
+def occluded(form, hides):
+    """
+    Takes (z, y, x) form ids padded by one cell on every side and a hides[form, direction] table.
+    Returns, for the inner cells, whether every neighbour hides the face towards the cell.
+    """
+    d, h, w = form.shape
+    hidden = numpy.ones((d - 2, h - 2, w - 2), numpy.bool_)
+    for i, (dx, dy, dz) in enumerate(DIRECTIONS.values()):
+        neighbour = form[1 + dz:d - 1 + dz, 1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx]
+        hidden &= hides[neighbour, i]
+    return hidden
+
+
 class Form(object):
     def __init__(self, name, vertices, indices):
+        self.id = None
         self.name = name
         self.vertices = vertices
         self.indices = indices
         self.num_vertices = len(vertices)
 
-    def hides(self, direction):
-        if self.name == 'Block':
-            return True
-        if self.name.startswith('Ramp') and direction == (0, 0, 1):
-            return True
-        return False
+
+class FormRegistry(object):
+    """
+    Gives every form a stable small integer id: Void is 0 and the rest follow in name order.
+
+    Behaviour is precomputed into arrays indexed by id: the solid, ramp, void and passable flags
+    and the hides[form, direction] table, with directions in DIRECTIONS order.
+    The extra id `outside` stands for cells outside the world: not passable, hiding everything.
+    """
+
+    def __init__(self, forms):
+        self.forms = sorted(forms, key=lambda f: (f.name != 'Void', f.name))
+        for i, f in enumerate(self.forms):
+            f.id = i
+
+        self.by_name = {f.name: f for f in self.forms}
+        self.ids = {f.name: f.id for f in self.forms}
+        self.outside = len(self.forms)
+
+        names = [f.name for f in self.forms]
+        self.solid = numpy.array([n == 'Block' for n in names] + [False])
+        self.ramp = numpy.array([n.startswith('Ramp') for n in names] + [False])
+        self.void = numpy.array([n == 'Void' for n in names] + [False])
+        self.passable = self.void.copy()
+
+        up = list(DIRECTIONS.values()).index(DIRECTIONS['up'])
+        self.hides = numpy.zeros((len(self.forms) + 1, len(DIRECTIONS)), numpy.bool_)
+        self.hides[self.solid] = True
+        self.hides[self.ramp, up] = True
+        self.hides[self.outside] = True
+
+    def __len__(self):
+        return len(self.forms)
+
+    def __getitem__(self, form_id):
+        return self.forms[form_id]
+
+    def names(self):
+        return [f.name for f in self.forms]
+
+
+RAMPS = [
+    ('RampWN', 'left', 'front'),
+    ('RampNE', 'front', 'right'),
+    ('RampES', 'right', 'back'),
+    ('RampSW', 'back', 'left'),
+    ('RampW', 'left', None),
+    ('RampE', 'right', None),
+    ('RampS', 'back', None),
+    ('RampN', 'front', None),
+]
 
 
 class Substance(object):
@@ -71,12 +186,12 @@ class Substance(object):
     DIRT = 1
     STONE = 2
 
+    NAMES = ['air', 'dirt', 'stone']
+
 
 class Block(object):
     __slots__ = ('form', 'substance', 'hidden', 'x', 'y', 'z', 'world')
 
-    FORMS = None
-
     def __init__(self, form, substance, hidden, pos, world):
         self.form = form
         self.substance = substance
@@ -86,19 +201,19 @@ class Block(object):
 
     @property
     def passable(self):
-        return self.form.name == 'Void'
+        return self.world.registry.passable[self.form.id]
 
     @property
     def is_block(self):
-        return self.form.name == 'Block'
+        return self.world.registry.solid[self.form.id]
 
     @property
     def is_void(self):
-        return self.form.name == 'Void'
+        return self.world.registry.void[self.form.id]
 
     @property
     def is_ramp(self):
-        return self.form.name.startswith('Ramp')
+        return self.world.registry.ramp[self.form.id]
 
     @property
     def up(self):
@@ -125,7 +240,7 @@ class Block(object):
         return self.world.get_block(self.x, self.y - 1, self.z)
 
     def hides(self, direction):
-        return self.form.hides(direction)
+        return self.world.registry.hides[self.form.id, list(DIRECTIONS.values()).index(direction)]
 
     def __str__(self):
         return '{}/{}/{}'.format(self.form.name, self.substance, self.hidden)
@@ -135,6 +250,19 @@ class Block(object):
 
 
 class NullBlock(Block):
+    """
+    Stands for any cell outside the world. There is a single shared instance, NULL_BLOCK.
+    """
+
+    def __init__(self):
+        Block.__init__(self, None, None, False, (None, None, None), None)
+
+    @property
+    def up(self):
+        return self
+
+    down = right = left = front = back = up
+
     @property
     def is_block(self):
         return False
@@ -158,10 +286,200 @@ class NullBlock(Block):
         return 'no block'
 
 
+NULL_BLOCK = NullBlock()
+
+
+class Terrain(object):
+    """
+    Heightfield terrain as 2D (y, x) fields: stone up to the height, a dirt layer
+    between the two noise heights and a ramp or floor cap on top.
+    """
+    def __init__(self, world, h, h2):
+        self.world = world
+        self.h = h
+        self.h2 = h2
+        self.top = numpy.clip(numpy.floor(numpy.maximum(h, h2)), -1, world.depth - 1).astype(numpy.int32)
+
+        cap = self.top + 1
+        top = numpy.pad(self.top, 1, 'constant', constant_values=-1)
+        lo = numpy.pad(h, 1, 'edge')
+        hi = numpy.pad(h2, 1, 'edge')
+
+        neighbours = {}
+        for name in ('left', 'right', 'front', 'back'):
+            dx, dy, _ = DIRECTIONS[name]
+            window = (slice(1 + dy, top.shape[0] - 1 + dy), slice(1 + dx, top.shape[1] - 1 + dx))
+            dirt = (lo[window] < cap) & (cap < hi[window])
+            neighbours[name] = (top[window] >= cap, numpy.where(dirt, Substance.DIRT, Substance.STONE))
+
+        below_dirt = (h < self.top) & (self.top < h2)
+        conditions = []
+        forms = []
+        substances = []
+        for form, a, b in RAMPS:
+            blocked, substance = neighbours[a]
+            if b is not None:
+                blocked = blocked & neighbours[b][0]
+            conditions.append(blocked)
+            forms.append(world.form_ids[form])
+            substances.append(substance)
+        conditions.append(below_dirt)
+        forms.append(world.form_ids['Floor'])
+        substances.append(Substance.DIRT)
+
+        valid = (self.top >= 0) & (cap < world.depth)
+        self.cap_form = numpy.where(valid, numpy.select(conditions, forms, world.form_ids['Void']), -1)
+        self.cap_substance = numpy.select(conditions, substances, Substance.AIR)
+
+    def box(self, x0, x1, y0, y1, z0, z1):
+        z = numpy.arange(z0, z1)[:, None, None]
+        window = (slice(y0, y1), slice(x0, x1))
+        top = self.top[window]
+
+        block = z <= top
+        dirt = (self.h[window] < z) & (z < self.h2[window])
+        cap = (z == top + 1) & (self.cap_form[window] >= 0)
+
+        form = numpy.where(block, self.world.form_ids['Block'], self.world.form_ids['Void'])
+        form = numpy.where(cap, self.cap_form[window], form)
+        substance = numpy.where(block, numpy.where(dirt, Substance.DIRT, Substance.STONE), Substance.AIR)
+        substance = numpy.where(cap, self.cap_substance[window], substance)
+        return form.astype(numpy.uint8), substance.astype(numpy.uint8)
+
+
+class Batch(object):
+    """
+    An edit transaction. Writes go straight to the store, but hidden flags of the
+    edited cells' neighbours are recomputed once at commit, and a single
+    `blocks-updated` message carries the set of (z, cx, cy) chunk tiles that changed.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.level = 0
+        # (cx, cy, cz) chunk key: (z, y, x) mask of the edited cells of the chunk
+        self.edited = {}
+        self.dirty = set()
+
+    def chunk_mask(self, key):
+        mask = self.edited.get(key)
+        if mask is None:
+            mask = self.edited[key] = numpy.zeros((CHUNK_DEPTH, CHUNK_SIZE, CHUNK_SIZE), numpy.bool_)
+        return mask
+
+    def edit(self, x0, y0, z0, mask):
+        """
+        Records the cells set in a (z, y, x) mask with its corner at (x0, y0, z0) as edited.
+        """
+        d, h, w = mask.shape
+        for key, local, rel in self.world.blocks.overlapping(x0, x0 + w, y0, y0 + h, z0, z0 + d):
+            part = mask[rel]
+            if part.any():
+                self.chunk_mask(key)[local] |= part
+
+    def edit_cell(self, x, y, z):
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_DEPTH)
+        self.chunk_mask(key)[z % CHUNK_DEPTH, y % CHUNK_SIZE, x % CHUNK_SIZE] = True
+
+    def neighbours(self):
+        """
+        The cells next to the edited ones, whose hidden flags may have changed,
+        as a dict of (cx, cy, cz) chunk key: (z, y, x) mask of the chunk.
+        """
+        d, h, w = CHUNK_DEPTH, CHUNK_SIZE, CHUNK_SIZE
+        # Per axis, the part of a grown chunk that spills into the chunk before it, itself, and the one after it
+        parts = [((-1, slice(0, 1), slice(n - 1, n)),
+                  (0, slice(1, n + 1), slice(0, n)),
+                  (1, slice(n + 1, n + 2), slice(0, 1))) for n in (w, h, d)]
+
+        neighbours = {}
+        for (cx, cy, cz), edited in self.edited.items():
+            padded = numpy.zeros((d + 4, h + 4, w + 4), numpy.bool_)
+            padded[2:-2, 2:-2, 2:-2] = edited
+
+            # The chunk grown by one cell on every side
+            grown = numpy.zeros((d + 2, h + 2, w + 2), numpy.bool_)
+            for dx, dy, dz in DIRECTIONS.values():
+                grown |= padded[1 + dz:d + 3 + dz, 1 + dy:h + 3 + dy, 1 + dx:w + 3 + dx]
+
+            for (ox, gx, lx), (oy, gy, ly), (oz, gz, lz) in itertools.product(*parts):
+                part = grown[gz, gy, gx]
+                if part.any():
+                    key = (cx + ox, cy + oy, cz + oz)
+                    if key not in neighbours:
+                        neighbours[key] = numpy.zeros((d, h, w), numpy.bool_)
+                    neighbours[key][lz, ly, lx] |= part
+        return neighbours
+
+    def __enter__(self):
+        self.level += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.level -= 1
+        if self.level == 0:
+            self.world.commit(self)
+        return False
+
+
+class Region(object):
+    """
+    A box of the world copied out into (z, y, x) form, substance and hidden arrays,
+    clipped to the world's extents; (x0, y0, z0) is the world position of index [0, 0, 0].
+
+    The arrays are read-only unless the region is writable. A writable region writes the cells
+    that were changed back through `World.write` when `commit` is called or its `with` block exits.
+    """
+
+    def __init__(self, world, x0, x1, y0, y1, z0, z1, writable=False):
+        self.world = world
+        self.x0, self.y0, self.z0 = max(x0, 0), max(y0, 0), max(z0, 0)
+        self.x1 = max(min(x1, world.width), self.x0)
+        self.y1 = max(min(y1, world.height), self.y0)
+        self.z1 = max(min(z1, world.depth), self.z0)
+        self.writable = writable
+
+        self.form, self.substance, self.hidden = world.blocks.read(self.x0, self.x1, self.y0, self.y1, self.z0, self.z1)
+        if writable:
+            self.original = tuple(a.copy() for a in (self.form, self.substance, self.hidden))
+        else:
+            for a in (self.form, self.substance, self.hidden):
+                a.flags.writeable = False
+
+    @property
+    def shape(self):
+        return self.form.shape
+
+    def commit(self, update_hidden=True):
+        """
+        Writes back every cell changed since the region was read or last committed.
+        Returns the mask of cells that changed in the world.
+        """
+        if not self.writable:
+            raise ValueError('Region is read-only')
+
+        form, substance, hidden = self.original
+        mask = (self.form != form) | (self.substance != substance) | (self.hidden != hidden)
+        changed = self.world.write(self.x0, self.y0, self.z0, self.form, self.substance, self.hidden,
+                                   mask, update_hidden)
+        self.original = tuple(a.copy() for a in (self.form, self.substance, self.hidden))
+        return changed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+
 class World(object):
     def __init__(self, width, height, depth):
-        self.forms = {f.name: f for f in load_forms()}
-        Block.FORMS = self.forms
+        self.registry = form_registry()
+        self.forms = self.registry.by_name
+        self.form_ids = self.registry.ids
+
         self.width = width
         self.height = height
         self.depth = depth
@@ -169,7 +487,18 @@ class World(object):
         self.size = core.Point3(self.width, self.height, self.depth)
         self.midpoint = core.Point3(self.width // 2, self.height // 2, self.depth // 2)
 
-        self.blocks = {coords: None for coords in self.grid()}
+        self.blocks = ChunkedStore(self.width, self.height, self.depth)
+        self.current_batch = None
+
+        self.surface_solid = numpy.full((self.height, self.width), -1, numpy.int16)
+        self.surface_visible = numpy.full((self.height, self.width), -1, numpy.int16)
+        self.surface_valid = numpy.zeros(self.blocks.grid_shape[1::-1], numpy.bool_)
+        self.surfaces = [
+            (self.surface_solid, self.registry.solid),
+            (self.surface_visible, ~self.registry.void),
+        ]
+        # solid: one past the highest level that may stop a ray, see `ceiling`
+        self.ceilings = {}
 
         self.notify = directNotify.newCategory('world')
         messenger.accept('console-command', self, self.command)
@@ -183,12 +512,42 @@ class World(object):
         )
 
     def get_raw(self, x, y, z):
-        return self.blocks[(x, y, z)]
+        f, s, h = self.blocks.get(x, y, z)
+        return self.registry[f], s, h
+
+    def form_id(self, x, y, z):
+        """
+        The form id at (x, y, z), or `registry.outside` for cells outside the world.
+        """
+        if 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth:
+            return self.blocks.get(x, y, z)[0]
+        return self.registry.outside
+
+    def neighbour_id(self, x, y, z, direction):
+        dx, dy, dz = DIRECTIONS[direction]
+        return self.form_id(x + dx, y + dy, z + dz)
+
+    def substance(self, x, y, z):
+        if 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth:
+            return self.blocks.get(x, y, z)[1]
+        return None
+
+    def is_block(self, x, y, z):
+        return self.registry.solid[self.form_id(x, y, z)]
+
+    def is_ramp(self, x, y, z):
+        return self.registry.ramp[self.form_id(x, y, z)]
+
+    def is_void(self, x, y, z):
+        return self.registry.void[self.form_id(x, y, z)]
+
+    def passable(self, x, y, z):
+        return self.registry.passable[self.form_id(x, y, z)]
 
     def get_block(self, x, y, z):
         p = (x, y, z)
         if p not in self:
-            return NullBlock(None, None, False, p, self)
+            return NULL_BLOCK
 
         b = self.get_raw(x, y, z)
         return Block(b[0], b[1], b[2], p, self)
@@ -197,25 +556,280 @@ class World(object):
         if (x, y, z) not in self:
             return False
 
-        old = self.blocks[(x, y, z)]
-        new = (form, substance, hidden)
-
-        if old != new:
-            self.blocks[(x, y, z)] = new
-            messenger.send('block-update', [(x, y, z)])
-
-            if update_hidden:
-                for dx, dy, dz in DIRECTIONS.values():
-                    self.update_hidden(x + dx, y + dy, z + dz)
+        with self.batch() as batch:
+            if self.blocks.set(x, y, z, form, substance, hidden):
+                batch.dirty.add((z, x // CHUNK_SIZE, y // CHUNK_SIZE))
+                self.update_surface(x, y, z, form)
+                if update_hidden:
+                    batch.edit_cell(x, y, z)
+
+    def region(self, x0, x1, y0, y1, z0, z1, writable=False):
+        """
+        The cells in the box [x0, x1) x [y0, y1) x [z0, z1) as a Region.
+        """
+        return Region(self, x0, x1, y0, y1, z0, z1, writable)
+
+    def write(self, x0, y0, z0, form, substance, hidden=False, mask=None, update_hidden=True):
+        """
+        Bulk version of `set_block`: writes (z, y, x) arrays or scalars with the corner at (x0, y0, z0),
+        only where `mask` is set. At least one of them must be an array, which gives the box its size;
+        the box must lie within the world.
+        Returns the mask of cells that changed.
+        """
+        with self.batch() as batch:
+            changed = self.blocks.write(x0, y0, z0, form, substance, hidden, mask)
+            if changed.any():
+                batch.dirty |= self.tiles(changed, x0, y0, z0)
+
+                d, h, w = changed.shape
+                self.invalidate_surface(x0, x0 + w, y0, y0 + h)
+                if update_hidden:
+                    batch.edit(x0, y0, z0, changed)
+        return changed
+
+    def surface(self, x, y, solid=False):
+        """
+        The z of the topmost non-void cell of a column (the topmost solid one with `solid`), or -1.
+        """
+        cx, cy = x // CHUNK_SIZE, y // CHUNK_SIZE
+        if not self.surface_valid[cy, cx]:
+            self.build_surface(cx, cy)
+        return int((self.surface_solid if solid else self.surface_visible)[y, x])
+
+    def heightmap(self, solid=False, x0=0, x1=None, y0=0, y1=None):
+        """
+        The (y, x) array of surface heights in [x0, x1) x [y0, y1), the whole world by default.
+        Only the chunk columns under the box are looked at. Treat it as read-only.
+        """
+        x1 = self.width if x1 is None else min(x1, self.width)
+        y1 = self.height if y1 is None else min(y1, self.height)
+        valid = self.surface_valid[y0 // CHUNK_SIZE:-(-y1 // CHUNK_SIZE), x0 // CHUNK_SIZE:-(-x1 // CHUNK_SIZE)]
+        for cy, cx in zip(*numpy.nonzero(~valid)):
+            self.build_surface(x0 // CHUNK_SIZE + cx, y0 // CHUNK_SIZE + cy)
+        return (self.surface_solid if solid else self.surface_visible)[y0:y1, x0:x1]
+
+    def ceiling(self, solid=False):
+        """
+        One past the highest level that may hold a non-void cell (a solid one with `solid`).
+        Judged from the chunk grid, top down, so chunks that are not loaded yet stay that way.
+        """
+        if solid not in self.ceilings:
+            stop = self.registry.solid if solid else ~self.registry.void
+            cw, ch, cd = self.blocks.grid_shape
+            top = 0
+            for cz in reversed(range(cd)):
+                for cx, cy in itertools.product(range(cw), range(ch)):
+                    value = self.blocks.uniform_value((cx, cy, cz))
+                    if value is None or stop[value[0]]:
+                        top = min((cz + 1) * CHUNK_DEPTH, self.depth)
+                        break
+                if top:
+                    break
+            self.ceilings[solid] = top
+        return self.ceilings[solid]
+
+    def raycast(self, origin, direction, solid=False, visited=None):
+        """
+        Marches a ray through the cells it crosses, where cell (x, y, z) spans [x - 0.5, x + 0.5] x
+        [y - 0.5, y + 0.5] x [z, z + 1], and stops at the first non-void cell (the first solid one with `solid`).
+        Returns that cell and the one the ray entered it from, or None if the ray leaves the world.
+        The cells passed are appended to the `visited` list, if given.
+        """
+        # Grid coordinates, where cells are unit cubes with their corner at (x, y, z)
+        o = (origin[0] + 0.5, origin[1] + 0.5, origin[2])
+        d = tuple(direction)
+        # Nothing above the highest chunk that holds anything can stop the ray
+        top = self.ceiling(solid)
+        bounds = (self.width, self.height, min(top, self.depth))
+        if top <= 0:
+            return None
+
+        # Clip the ray to the box of the world below the surface
+        t0, t1 = 0.0, float('inf')
+        axis = max(range(3), key=lambda i: abs(d[i]))
+        for i in range(3):
+            if d[i] == 0:
+                if not 0 <= o[i] < bounds[i]:
+                    return None
+                continue
+            a, b = -o[i] / d[i], (bounds[i] - o[i]) / d[i]
+            if min(a, b) > t0:
+                t0, axis = min(a, b), i
+            t1 = min(t1, max(a, b))
+        if t0 > t1:
+            return None
+
+        step = [1 if c > 0 else -1 for c in d]
+        cell = []
+        t_max = []
+        t_delta = []
+        for i in range(3):
+            c = o[i] + d[i] * t0
+            n = int(math.floor(c))
+            if d[i] < 0 and c == n:
+                n -= 1
+            n = min(max(n, 0), bounds[i] - 1)
+            cell.append(n)
+            if d[i] == 0:
+                t_max.append(float('inf'))
+                t_delta.append(float('inf'))
+            else:
+                edge = n + (1 if d[i] > 0 else 0)
+                t_max.append((edge - o[i]) / d[i])
+                t_delta.append(abs(1.0 / d[i]))
+
+        stop = self.registry.solid if solid else ~self.registry.void
+        previous = None
+        while True:
+            x, y, z = cell
+            if visited is not None:
+                visited.append((x, y, z))
+            if stop[self.blocks.get(x, y, z)[0]]:
+                if previous is None:
+                    previous = list(cell)
+                    previous[axis] -= step[axis]
+                return (x, y, z), tuple(previous)
+
+            previous = list(cell)
+            axis = min(range(3), key=t_max.__getitem__)
+            cell[axis] += step[axis]
+            if not 0 <= cell[axis] < bounds[axis]:
+                return None
+            t_max[axis] += t_delta[axis]
+
+    def build_surface(self, cx, cy):
+        """
+        Finds the surfaces of a chunk column top down, one chunk at a time, until every column has hit them.
+        Uniform chunks are judged by their value, so the chunks below the surface are never loaded.
+        """
+        x0, x1 = cx * CHUNK_SIZE, min((cx + 1) * CHUNK_SIZE, self.width)
+        y0, y1 = cy * CHUNK_SIZE, min((cy + 1) * CHUNK_SIZE, self.height)
+        columns = [(heights[y0:y1, x0:x1], flags) for heights, flags in self.surfaces]
+        for heights, _ in columns:
+            heights[...] = -1
+
+        for cz in reversed(range(self.blocks.grid_shape[2])):
+            # Columns still at -1 have not met their surface yet
+            columns = [(heights, flags) for heights, flags in columns if (heights < 0).any()]
+            if not columns:
+                break
+
+            z0, z1 = cz * CHUNK_DEPTH, min((cz + 1) * CHUNK_DEPTH, self.depth)
+            value = self.blocks.uniform_value((cx, cy, cz))
+            form = None if value is not None else self.blocks.read(x0, x1, y0, y1, z0, z1)[0]
+            for heights, flags in columns:
+                if value is not None:
+                    if flags[value[0]]:
+                        heights[heights < 0] = z1 - 1
+                    continue
+                mask = flags[form][::-1]
+                found = mask.any(axis=0) & (heights < 0)
+                heights[found] = (z1 - 1 - mask.argmax(axis=0))[found]
+        self.surface_valid[cy, cx] = True
+
+    def update_surface(self, x, y, z, form):
+        self.ceilings = {}
+        if not self.surface_valid[y // CHUNK_SIZE, x // CHUNK_SIZE]:
+            return
+
+        for heights, flags in self.surfaces:
+            top = heights[y, x]
+            if flags[form]:
+                if z > top:
+                    heights[y, x] = z
+            elif z == top:
+                below = numpy.flatnonzero(flags[self.blocks.read(x, x + 1, y, y + 1, 0, z)[0][:, 0, 0]])
+                heights[y, x] = below[-1] if len(below) else -1
+
+    def invalidate_surface(self, x0=0, x1=None, y0=0, y1=None):
+        x1 = self.width if x1 is None else x1
+        y1 = self.height if y1 is None else y1
+        self.ceilings = {}
+        self.surface_valid[y0 // CHUNK_SIZE:-(-y1 // CHUNK_SIZE), x0 // CHUNK_SIZE:-(-x1 // CHUNK_SIZE)] = False
 
     def update_hidden(self, x, y, z):
-        b = self.get_block(x, y, z)
-        if all(f.hides(d) for d, (f, s, h) in self.neighborhood(x, y, z)):
-            b.hidden = True
-        else:
-            b.hidden = False
-
-        self.set_block(x, y, z, b.form, b.substance, b.hidden, False)
+        if (x, y, z) not in self:
+            return
+
+        with self.batch() as batch:
+            batch.dirty |= self.recompute_hidden(x, x + 1, y, y + 1, z, z + 1)
+
+    def batch(self):
+        """
+        Returns the current edit transaction, starting one if needed. Use as a context manager;
+        nested transactions join the outermost one, which commits when it exits.
+        """
+        if self.current_batch is None:
+            self.current_batch = Batch(self)
+        return self.current_batch
+
+    def commit(self, batch):
+        self.current_batch = None
+
+        grid = self.blocks.grid_shape
+        for (cx, cy, cz), mask in batch.neighbours().items():
+            if not (0 <= cx < grid[0] and 0 <= cy < grid[1] and 0 <= cz < grid[2]):
+                continue
+            x0, y0, z0 = cx * CHUNK_SIZE, cy * CHUNK_SIZE, cz * CHUNK_DEPTH
+            x1, y1, z1 = (min(x0 + CHUNK_SIZE, self.width), min(y0 + CHUNK_SIZE, self.height),
+                          min(z0 + CHUNK_DEPTH, self.depth))
+            batch.dirty |= self.recompute_hidden(x0, x1, y0, y1, z0, z1, mask[:z1 - z0, :y1 - y0, :x1 - x0])
+
+        if batch.dirty:
+            messenger.send('blocks-updated', [batch.dirty])
+
+    def recompute_hidden(self, x0=0, x1=None, y0=0, y1=None, z0=0, z1=None, mask=None):
+        """
+        Recomputes the hidden flag of every cell in the box (the whole world by default),
+        or only where `mask` is set, one chunk at a time. No messages are sent.
+        Returns the set of (z, cx, cy) chunk tiles that changed.
+        """
+        x1 = self.width if x1 is None else x1
+        y1 = self.height if y1 is None else y1
+        z1 = self.depth if z1 is None else z1
+
+        def forms(*box):
+            return self.blocks.read(*box)[0]
+
+        dirty = set()
+        for key, local, (rz, ry, rx) in self.blocks.overlapping(x0, x1, y0, y1, z0, z1):
+            bx0, bx1 = x0 + rx.start, x0 + rx.stop
+            by0, by1 = y0 + ry.start, y0 + ry.stop
+            bz0, bz1 = z0 + rz.start, z0 + rz.stop
+
+            padded = self.padded(forms, bx0, bx1, by0, by1, bz0, bz1)
+            hidden = occluded(padded, self.registry.hides)
+            form, substance, _ = self.blocks.read(bx0, bx1, by0, by1, bz0, bz1)
+            changed = self.blocks.write(bx0, by0, bz0, form, substance, hidden,
+                                        None if mask is None else mask[rz, ry, rx])
+            dirty |= self.tiles(changed, bx0, by0, bz0)
+
+        return dirty
+
+    def tiles(self, changed, x0, y0, z0):
+        """
+        The set of (z, cx, cy) chunk tiles touched by a boolean (z, y, x) mask with its corner at (x0, y0, z0).
+        """
+        d, h, w = changed.shape
+        dirty = set()
+        for (cx, cy, cz), local, (rz, ry, rx) in self.blocks.overlapping(x0, x0 + w, y0, y0 + h, z0, z0 + d):
+            levels = changed[rz, ry, rx].any(axis=(1, 2))
+            dirty.update((int(z0 + rz.start + z), cx, cy) for z in numpy.flatnonzero(levels))
+        return dirty
+
+    def padded(self, read, x0, x1, y0, y1, z0, z1):
+        """
+        Form ids of the box grown by one cell on every side, as returned by `read`,
+        with cells outside the world set to `registry.outside`.
+        """
+        form = numpy.full((z1 - z0 + 2, y1 - y0 + 2, x1 - x0 + 2), self.registry.outside, numpy.uint8)
+        ax0, ax1 = max(x0 - 1, 0), min(x1 + 1, self.width)
+        ay0, ay1 = max(y0 - 1, 0), min(y1 + 1, self.height)
+        az0, az1 = max(z0 - 1, 0), min(z1 + 1, self.depth)
+        form[az0 - z0 + 1:az1 - z0 + 1,
+             ay0 - y0 + 1:ay1 - y0 + 1,
+             ax0 - x0 + 1:ax1 - x0 + 1] = read(ax0, ax1, ay0, ay1, az0, az1)
+        return form
 
     def grid(self):
         return itertools.product(range(self.width), range(self.height), range(self.depth))
@@ -243,63 +857,34 @@ class World(object):
                 yield (dx, dy, dz), self.get_raw(rx, ry, rz)
 
     def make_ramp(self, x, y, z, update_hidden=True):
-        b = self.get_block(x, y, z)
-
-        if b.left.is_block and b.front.is_block:
-            f, s = 'RampWN', b.left.substance
-        elif b.front.is_block and b.right.is_block:
-            f, s = 'RampNE', b.front.substance
-        elif b.right.is_block and b.back.is_block:
-            f, s = 'RampES', b.right.substance
-        elif b.back.is_block and b.left.is_block:
-            f, s = 'RampSW', b.back.substance
-        elif b.left.is_block:
-            f, s = 'RampW', b.left.substance
-        elif b.right.is_block:
-            f, s = 'RampE', b.right.substance
-        elif b.back.is_block:
-            f, s = 'RampS', b.back.substance
-        elif b.front.is_block:
-            f, s = 'RampN', b.front.substance
-        else:
-            return False
+        for f, a, b in RAMPS:
+            if self.registry.solid[self.neighbour_id(x, y, z, a)]:
+                if b is None or self.registry.solid[self.neighbour_id(x, y, z, b)]:
+                    dx, dy, dz = DIRECTIONS[a]
+                    s = self.substance(x + dx, y + dy, z + dz)
+                    self.set_block(x, y, z, self.form_ids[f], s, False, update_hidden)
+                    return True
 
-        self.set_block(x, y, z, self.forms[f], s, False, update_hidden)
-        return True
+        return False
 
     def generate(self):
         self.notify.info('Generation started')
         fbm = core.StackedPerlinNoise2(100, 100, 5, 2.01, 0.65)
-        for x, y in self.columns():
-            h = fbm.noise(x, y) * 20 + self.midpoint.z
-            h2 = fbm.noise(x, y) * 7 + self.midpoint.z
-
-            for z in range(self.depth):
-                i = (x, y, z)
-                if z > max(h, h2):
-                    self.blocks[i] = (self.forms['Void'], Substance.AIR, False)
-                elif h < z < h2:
-                    self.blocks[i] = (self.forms['Block'], Substance.DIRT, True)
-                else:
-                    self.blocks[i] = (self.forms['Block'], Substance.STONE, True)
-
-        self.notify.info('Making ramps')
-        for x, y, z in self.grid():
-            if z > 0:
-                f = self.get_raw(x, y, z)[0]
-                fd, sd, _ = self.get_raw(x, y, z - 1)
-                if f.name == 'Void':
-                    if fd.name == 'Block':
-                        if not self.make_ramp(x, y, z, False):
-                            if sd == Substance.DIRT:
-                                self.set_block(x, y, z, self.forms['Floor'], sd, False, False)
+        noise = numpy.array([[fbm.noise(x, y) for x in range(self.width)] for y in range(self.height)])
+        terrain = Terrain(self, noise * 20 + self.midpoint.z, noise * 7 + self.midpoint.z)
+
+        self.notify.info('Filling chunks')
+        for key in self.blocks.chunk_keys():
+            c = self.blocks.chunk(key, create=True)
+            x0, y0, z0 = c.origin
+            z1, y1, x1 = z0 + c.shape[0], y0 + c.shape[1], x0 + c.shape[2]
+
+            form, substance = terrain.box(x0, x1, y0, y1, z0, z1)
+            self.blocks.write(x0, y0, z0, form, substance, False)
 
         self.notify.info('Updating hidden blocks')
-        for x, y, z in self.grid():
-            f, s, h = self.get_raw(x, y, z)
-            if f.name == 'Block':
-                self.update_hidden(x, y, z)
-                continue
+        self.recompute_hidden()
+        self.invalidate_surface()
         self.notify.info('Generation complete')
 
     def command(self, args):
@@ -309,33 +894,151 @@ class World(object):
         if cmd == 'save':
             fn = args.pop(0)
             self.save(fn)
+        if cmd == 'chunk-stats':
+            stats = self.blocks.stats()
+            self.notify.info(
+                '{chunks} chunks: {dense} dense, {uniform} uniform, {unloaded} not loaded, '
+                '{unallocated} unallocated; {bytes} bytes instead of {dense_bytes}'.format(**stats)
+            )
+        if cmd == 'compression':
+            source = savefile.ChunkFile(savefile.with_extension(args.pop(0), savefile.CHUNKED_EXTENSION))
+            stats = source.stats()
+            source.close()
+            self.notify.info(
+                '{chunks} chunks: {stored} stored, {uniform} uniform; '
+                '{file_bytes} bytes instead of {raw_bytes}, ratio {ratio:.1f}'.format(**stats)
+            )
 
     @staticmethod
     def load(fn):
+        ext = os.path.splitext(fn)[1]
+        if ext == '.json':
+            return World.load_json(fn)
+        if ext == savefile.CHUNKED_EXTENSION:
+            return World.load_chunked(fn)
+
+        extents, forms, substances, (form, substance, hidden) = savefile.load(fn)
+        w = World(*extents)
+
+        lookups = w.lookups(forms, substances)
+        if lookups is None:
+            w.blocks.attach(form, substance, hidden)
+        else:
+            form_lookup, substance_lookup = lookups
+            w.blocks.write(0, 0, 0, form_lookup[form], substance_lookup[substance], hidden)
+            w.blocks.compact()
+
+        return w
+
+    @staticmethod
+    def load_chunked(fn):
+        source = savefile.ChunkFile(fn)
+        if (source.chunk_size, source.chunk_depth) != (CHUNK_SIZE, CHUNK_DEPTH):
+            raise ValueError('{} uses {}x{} chunks'.format(fn, source.chunk_size, source.chunk_depth))
+
+        w = World(*source.extents)
+        lookups = w.lookups(source.forms, source.substances)
+        if lookups is not None:
+            source.remap(*lookups)
+        w.blocks.attach_source(source)
+
+        journal = fn + savefile.JOURNAL_SUFFIX
+        if os.path.exists(journal):
+            w.replay(journal, source.checkpoint)
+        return w
+
+    def replay(self, fn, checkpoint):
+        """
+        Applies the chunks recorded in a journal on top of the checkpoint it was started from.
+        """
+        journal_checkpoint, forms, substances, records = savefile.read_journal(fn)
+        if journal_checkpoint != checkpoint:
+            self.notify.warning('Ignoring stale journal {}'.format(fn))
+            return
+
+        lookups = self.lookups(forms, substances)
+        for key, (f, s, h), data in records:
+            if lookups is not None:
+                f, s = int(lookups[0][f]), int(lookups[1][s])
+            c = self.blocks.replace(key, (f, s, h))
+
+            if data is not None:
+                form, substance, hidden = savefile.unpack_chunk(data, c.shape)
+                if lookups is not None:
+                    form, substance = lookups[0][form], lookups[1][substance]
+                c.form, c.substance, c.hidden = form, substance, hidden
+
+    def lookups(self, forms, substances):
+        """
+        Arrays mapping form and substance ids of a saved world to ours, or None if they are the same.
+        """
+        form_lookup = numpy.array([self.form_ids[name] for name in forms], numpy.uint8)
+        substance_lookup = numpy.array([Substance.NAMES.index(name) for name in substances], numpy.uint8)
+
+        if (form_lookup == numpy.arange(len(forms))).all() and \
+                (substance_lookup == numpy.arange(len(substances))).all():
+            return None
+        return form_lookup, substance_lookup
+
+    @staticmethod
+    def load_json(fn):
         with open(fn) as f:
             data = json.load(f)
 
         w = World(*data['extents'])
-        f = data['forms']
-
-        for (x, y, z, b), datum in zip(w.all(), data['data']):
-            i = (x, y, z)
-            form, substance, hidden = datum
-            w.blocks[i] = (w.forms[f[form]], substance, hidden)
+        width, height, depth = data['extents']
+        form_lookup = numpy.array([w.form_ids[name] for name in data['forms']], numpy.uint8)
 
+        cells = numpy.array(data['data'], numpy.uint8).reshape(width, height, depth, 3).transpose(2, 1, 0, 3)
+        w.blocks.write(0, 0, 0, form_lookup[cells[..., 0]], cells[..., 1], cells[..., 2].astype(numpy.bool_))
+        w.blocks.compact()
         return w
 
     def save(self, fn):
-        forms = self.forms.keys()
-        formmap = {f: i for i, f in enumerate(forms)}
-        x, y, z = self.size
+        """
+        Saves in the format given by the extension of `fn`, as a .dorf file when there is none.
+        """
+        fn = savefile.with_extension(fn, savefile.EXTENSION)
+        ext = os.path.splitext(fn)[1]
+        if ext == '.json':
+            self.save_json(fn)
+        elif ext == savefile.EXTENSION:
+            self.save_binary(fn)
+        elif ext == savefile.CHUNKED_EXTENSION:
+            # Chunks that are not loaded yet are still read from fn, so it is only replaced once complete
+            self.save_chunked(fn + '.tmp', self.blocks)
+            os.replace(fn + '.tmp', fn)
+        else:
+            raise ValueError('Unknown world file extension: {}'.format(ext))
+
+    def save_chunked(self, fn, store, checkpoint=None):
+        savefile.save_chunked(fn, (self.width, self.height, self.depth),
+                              self.registry.names(), Substance.NAMES,
+                              store, CHUNK_SIZE, CHUNK_DEPTH, checkpoint)
+
+    def start_journal(self, fn, checkpoint):
+        savefile.start_journal(fn, (self.width, self.height, self.depth),
+                               self.registry.names(), Substance.NAMES, checkpoint)
+
+    def save_binary(self, fn):
+        # The world may be memory mapped from fn itself, so it is only replaced once complete
+        data = savefile.create(fn + '.tmp', (self.width, self.height, self.depth),
+                               self.registry.names(), Substance.NAMES)
+        for z0 in range(0, self.depth, CHUNK_DEPTH):
+            z1 = min(z0 + CHUNK_DEPTH, self.depth)
+            for i, a in enumerate(self.blocks.read(0, self.width, 0, self.height, z0, z1)):
+                data[i, z0:z1] = a
+        data.flush()
+        del data
+        os.replace(fn + '.tmp', fn)
+
+    def save_json(self, fn):
+        form, substance, hidden = self.blocks.read(0, self.width, 0, self.height, 0, self.depth)
+        cells = numpy.stack([form, substance, hidden], -1).transpose(2, 1, 0, 3).reshape(-1, 3)
         data = {
-            'extents': [int(x), int(y), int(z)],
-            'forms': forms,
-            'data': [
-                (formmap[b.form.name], b.substance, int(b.hidden))
-                for x, y, z, b in self.all()
-            ]
+            'extents': [self.width, self.height, self.depth],
+            'forms': self.registry.names(),
+            'data': cells.tolist()
         }
         with open(fn, 'w') as f:
             json.dump(data, f)
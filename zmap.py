@@ -1,40 +1,54 @@
+import time
+
 from direct.showbase.DirectObject import DirectObject
 
-from panda3d.core import Point2, VBase3D, PNMImage, Texture, CardMaker, LVecBase3f, LRGBColorf
+import numpy
+from panda3d.core import Point2, Texture, CardMaker
+
+from storage import CHUNK_SIZE, CHUNK_DEPTH
 
 
 class ZMap(DirectObject):
-    COLORS = [
-        VBase3D(0.7, 0.7, 0.9),  # AIR
-        VBase3D(0.4, 0.5, 0.1),  # DIRT
-        VBase3D(0.6, 0.6, 0.6)   # STONE
-    ]
+    """
+    A side profile of the world: texel (x, z) mixes the colours of the substances of the cells
+    (x, *, z), weighted by how many there are.
+
+    The counts are kept per chunk tile, so a changed tile only replaces its own share of the
+    counts, and only the changed texels are written into the texture, at most once per frame.
+    Uniform chunks are counted from their values; the others are loaded and counted within a
+    budget of BUDGET milliseconds per frame, nearest to the current slice first.
+    """
+    COLORS = numpy.array([
+        (0.7, 0.7, 0.9),  # AIR
+        (0.4, 0.5, 0.1),  # DIRT
+        (0.6, 0.6, 0.6),  # STONE
+    ])
+    ROWS = 256
+    BUDGET = 2.0
 
     def __init__(self, world, app):
         self.world = world
+        self.rows = max(ZMap.ROWS, self.world.depth)
+
+        ny = -(-self.world.height // CHUNK_SIZE)
+        # tiles[z, cy, x, substance] counts the cells of each substance in the tile's share of column (x, z),
+        # at most CHUNK_SIZE
+        self.tiles = numpy.zeros((self.world.depth, ny, self.world.width, len(ZMap.COLORS)), numpy.uint8)
+        self.counts = numpy.zeros((self.world.depth, self.world.width, len(ZMap.COLORS)), numpy.int32)
+        self.dirty = set()
+        self.uncounted = []
+        self.slice = 0
+        self.ordered_for = None
 
-        self.image = PNMImage(self.world.width, 256)
-
-        for z in self.world.zlevels():
-            for x in range(self.world.height):
-                mix = sum([ZMap.COLORS[self.world.get_block(x, y, z).substance]
-                          for y in range(self.world.height)], VBase3D(0.0))
-                color_block = mix / float(self.world.height)
-                #print(color_block)
-                #self.image.setXel(int(x), int(z), mix / float(self.world.height))
-                self.image.setXel(
-                    int(x), int(z), 
-                    LRGBColorf(color_block[0], color_block[1], color_block[2])
-                    )
-
-        self.texture = Texture()
-        self.texture.load(self.image)
+        self.texture = Texture('zmap')
+        self.texture.setup2dTexture(self.world.width, self.rows, Texture.TUnsignedByte, Texture.FRgb)
         self.texture.setMagfilter(Texture.FTNearest)
         self.texture.setMinfilter(Texture.FTNearest)
+        self.update_all()
 
         cm = CardMaker('zmap')
         cm.setFrame(0.95, 1, -1, 1)
-        cm.setUvRange(Point2(1.0, 1.0), Point2(0.0, 1.0 - self.world.depth / 256.0))
+        cm.setUvRange(Point2(1.0, 0.0), Point2(0.0, self.world.depth / float(self.rows)))
         self.zcard = app.render2d.attachNewNode(cm.generate())
         self.zcard.setTexture(self.texture)
 
@@ -44,7 +58,92 @@ class ZMap(DirectObject):
         self.zpointer.setColorScale(1.0, 0.0, 0.0, 0.4)
 
         self.accept('slice-changed', self.slice_changed)
+        self.accept('blocks-updated', self.blocks_updated)
+        self.addTask(self.update, 'ZMap update')
+
+    def count(self, substance):
+        """
+        Counts the substances of (z, y, x) cells per chunk tile row, as (z, tile rows, x, substance).
+        """
+        d, h, w = substance.shape
+        ny = -(-h // CHUNK_SIZE)
+        # Rows past the edge of the world hold a substance that is never counted
+        padded = numpy.full((d, ny * CHUNK_SIZE, w), len(ZMap.COLORS), substance.dtype)
+        padded[:, :h] = substance
+        padded = padded.reshape(d, ny, CHUNK_SIZE, w)
+        return numpy.stack([(padded == s).sum(axis=2) for s in range(len(ZMap.COLORS))], axis=-1)
+
+    def update_all(self):
+        """
+        Recounts the whole world: the uniform chunks right away, the others queued for `update`.
+        """
+        blocks = self.world.blocks
+        cw, ch, cd = blocks.grid_shape
+        # The substance of every uniform chunk, or one that is never counted
+        uniform = numpy.full((cd, ch, cw), len(ZMap.COLORS), numpy.int16)
+        self.uncounted = []
+        for key in blocks.chunk_keys():
+            value = blocks.uniform_value(key)
+            if value is None:
+                self.uncounted.append(key)
+            else:
+                cx, cy, cz = key
+                uniform[cz, cy, cx] = value[1]
+        self.ordered_for = None
+
+        rows = numpy.minimum(self.world.height - numpy.arange(ch) * CHUNK_SIZE, CHUNK_SIZE)
+        substance = numpy.repeat(numpy.repeat(uniform, CHUNK_DEPTH, axis=0)[:self.world.depth],
+                                 CHUNK_SIZE, axis=2)[:, :, :self.world.width]
+        self.tiles[...] = (substance[..., None] == numpy.arange(len(ZMap.COLORS))) * rows[:, None, None]
+        self.counts = self.tiles.sum(axis=1, dtype=numpy.int32)
+        self.dirty = set()
+        self.paint(0, self.world.depth, 0, self.world.width)
+
+    def count_chunk(self, key):
+        """
+        Replaces the share of the counts of a whole chunk.
+        """
+        cx, cy, cz = key
+        region = self.world.region(cx * CHUNK_SIZE, (cx + 1) * CHUNK_SIZE, cy * CHUNK_SIZE, (cy + 1) * CHUNK_SIZE,
+                                   cz * CHUNK_DEPTH, (cz + 1) * CHUNK_DEPTH)
+        tiles = self.count(region.substance)[:, 0]
+        z0, z1, x0, x1 = region.z0, region.z1, region.x0, region.x1
+        self.counts[z0:z1, x0:x1] += tiles - self.tiles[z0:z1, cy, x0:x1].astype(numpy.int32)
+        self.tiles[z0:z1, cy, x0:x1] = tiles
+        self.paint(z0, z1, x0, x1)
+
+    def paint(self, z0, z1, x0, x1):
+        colors = self.counts[z0:z1, x0:x1].dot(ZMap.COLORS) / float(self.world.height)
+        image = numpy.frombuffer(memoryview(self.texture.modifyRamImage()), numpy.uint8)
+        image = image.reshape(self.rows, self.world.width, 3)
+        # RAM images are stored as BGR, bottom row first
+        image[z0:z1, x0:x1] = numpy.round(colors[..., ::-1] * 255)
+
+    def blocks_updated(self, chunks):
+        self.dirty |= chunks
+
+    def update(self, task):
+        for z, cx, cy in self.dirty:
+            region = self.world.region(cx * CHUNK_SIZE, (cx + 1) * CHUNK_SIZE,
+                                       cy * CHUNK_SIZE, (cy + 1) * CHUNK_SIZE, z, z + 1)
+            tile = self.count(region.substance)[0, 0]
+            x0, x1 = region.x0, region.x1
+            self.counts[z, x0:x1] += tile - self.tiles[z, cy, x0:x1].astype(numpy.int32)
+            self.tiles[z, cy, x0:x1] = tile
+            self.paint(z, z + 1, x0, x1)
+        self.dirty = set()
+
+        if self.uncounted:
+            if self.ordered_for != self.slice:
+                # Nearest last, as they are popped from the end
+                self.uncounted.sort(key=lambda key: abs(key[2] * CHUNK_DEPTH + CHUNK_DEPTH // 2 - self.slice),
+                                    reverse=True)
+                self.ordered_for = self.slice
+            deadline = time.perf_counter() + ZMap.BUDGET / 1000.0
+            while self.uncounted and time.perf_counter() < deadline:
+                self.count_chunk(self.uncounted.pop())
+        return task.cont
 
     def slice_changed(self, slice, explore):
+        self.slice = slice
         self.zpointer.setPos(0.95, 0.0, slice * 2.0 / self.world.depth - 1.0)
-